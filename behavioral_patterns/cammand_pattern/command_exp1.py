@@ -2,15 +2,30 @@
 """
 EXAMPLE - https://github.com/azmikamis/pipbook/blob/master/any/grid.py
 """
+import bisect
+import contextlib
+import functools
+import itertools
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+from array import array
 
 
 class Command:
 
-    def __init__(self, do, undo, description=""):
+    def __init__(self, do, undo, description="", writes=None, forget=None):
         assert callable(do) and callable(undo)
         self.do = do
         self.undo = undo
         self.description = description
+        # (grid, x0, y0, x1, y1, color) if do() just paints that block
+        self.writes = writes
+        # Drops the undo data saved by do(); do() can still be replayed
+        self.forget = forget if forget is not None else lambda: None
 
     def __call__(self):
         self.do()
@@ -28,6 +43,9 @@ class Macro:
                             format(type(command).__name__))
         self.__commands.append(command)
 
+    def __iter__(self):
+        return iter(self.__commands)
+
     def __call__(self):
         for command in self.__commands:
             command()
@@ -38,10 +56,231 @@ class Macro:
         for command in reversed(self.__commands):
             command.undo()
 
+    def forget(self):
+        for command in self.__commands:
+            command.forget()
+
+    def compile(self):
+        """
+        Return an equivalent Macro in which each run of consecutive
+        commands with known writes to one grid is fused into a single
+        Command: each block write cuts what it overwrites out of the
+        earlier writes (only single cells are kept cell by cell), and what
+        survives is merged into same-colored rectangles, each painted with
+        one fill_rect() and restored from one Region.
+        """
+        macro = Macro(self.description)
+        run = []
+        for command in self.__commands:
+            if run and (command.writes is None or
+                        command.writes[0] is not run[0].writes[0]):
+                macro.add(_fuse(run))
+                run = []
+            if command.writes is None:
+                macro.add(command)
+            else:
+                run.append(command)
+        if run:
+            macro.add(_fuse(run))
+        return macro
+
+
+def _fuse(commands):
+    if len(commands) == 1:
+        return commands[0]
+
+    grid = commands[0].writes[0]
+    pieces = []  # Disjoint [x0, y0, x1, y1, color] blocks
+    columns = {}  # x -> {y: color} of single cells, newer than any piece
+    for _, x0, y0, x1, y1, color in (command.writes for command in commands):
+        if x0 == x1 and y0 == y1:
+            columns.setdefault(x0, {})[y0] = color
+            continue
+        pieces = [piece for old in pieces
+                  for piece in _subtract(old, x0, y0, x1, y1)]
+        pieces.append([x0, y0, x1, y1, color])
+        for x in [x for x in columns if x0 <= x <= x1]:
+            column = columns[x]
+            for y in [y for y in column if y0 <= y <= y1]:
+                del column[y]
+
+    # Cut the grid into strips of columns along the edges of the pieces
+    # and around every column with cells; in a strip each piece is one
+    # span of the same rows
+    edges = sorted({x for x0, _, x1, _, _ in pieces for x in (x0, x1 + 1)} |
+                   {x for x in columns for x in (x, x + 1)})
+    rectangles = []
+    open_rectangles = {}  # (y0, y1, color) -> index of rectangle ending at x-1
+    for x, next_x in zip(edges, edges[1:]):
+        spans = _column_spans(
+            sorted(piece[1:] for piece in pieces if piece[0] <= x <= piece[2]),
+            columns.get(x, {}))
+        still_open = {}
+        for y0, y1, color in spans:
+            key = (y0, y1, color)
+            index = open_rectangles.get(key)
+            if index is not None and rectangles[index][2] == x - 1:
+                rectangles[index][2] = next_x - 1
+            else:
+                index = len(rectangles)
+                rectangles.append([x, y0, next_x - 1, y1, color])
+            still_open[key] = index
+        open_rectangles = still_open
+
+    befores = []
+
+    def undo():
+        for (x0, y0, _, _, _), before in zip(reversed(rectangles),
+                                             reversed(befores)):
+            grid.paste_region(x0, y0, before)
+
+    def do():
+        befores[:] = [grid.copy_region(*rectangle[:4])
+                      for rectangle in rectangles]
+        for rectangle in rectangles:
+            grid.fill_rect(*rectangle)
+
+    return Command(do, undo, "Fused {} commands".format(len(commands)),
+                   forget=befores.clear)
+
+
+def _column_spans(blocks, cells):
+    """
+    The [y0, y1, color] spans of a column where the cells {y: color} are
+    painted over the blocks, given as sorted disjoint (y0, x1, y1, color).
+    Touching spans of one color are merged.
+    """
+    spans = []
+
+    def add(y0, y1, color):
+        if spans and spans[-1][1] == y0 - 1 and spans[-1][2] == color:
+            spans[-1][1] = y1
+        else:
+            spans.append([y0, y1, color])
+
+    ys = sorted(cells)
+    i = 0
+    for y0, _, y1, color in blocks:
+        while i < len(ys) and ys[i] < y0:
+            add(ys[i], ys[i], cells[ys[i]])
+            i += 1
+        y = y0
+        while i < len(ys) and ys[i] <= y1:
+            if y < ys[i]:
+                add(y, ys[i] - 1, color)
+            add(ys[i], ys[i], cells[ys[i]])
+            y = ys[i] + 1
+            i += 1
+        if y <= y1:
+            add(y, y1, color)
+    for y in ys[i:]:
+        add(y, y, cells[y])
+    return spans
+
+
+def _subtract(piece, x0, y0, x1, y1):
+    """The parts of piece [x0, y0, x1, y1, color] outside the block."""
+    px0, py0, px1, py1, color = piece
+    if x0 > px1 or x1 < px0 or y0 > py1 or y1 < py0:
+        return [piece]
+    parts = []
+    if px0 < x0:
+        parts.append([px0, py0, x0 - 1, py1, color])
+    if x1 < px1:
+        parts.append([x1 + 1, py0, px1, py1, color])
+    mx0, mx1 = max(px0, x0), min(px1, x1)
+    if py0 < y0:
+        parts.append([mx0, py0, mx1, y0 - 1, color])
+    if y1 < py1:
+        parts.append([mx0, y1 + 1, mx1, py1, color])
+    return parts
+
+
+class Region:
+    """
+    Compact before-image of a rectangular block of cells: the distinct
+    colors of the block plus one palette index per cell, column by column.
+    """
+
+    __slots__ = ("width", "height", "palette", "indices")
+
+    def __init__(self, width, height, palette, indices):
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.indices = indices
+
+    def column(self, dx):
+        """Colors of the dx-th column of the block."""
+        start = dx * self.height
+        return [self.palette[i]
+                for i in self.indices[start:start + self.height]]
+
+    def row_key(self, dy):
+        return self.indices[dy::self.height]
+
+    def row_runs(self, dy):
+        """The (dx0, dx1, color) runs covering the dy-th row of the block."""
+        runs = []
+        start = 0
+        for index, group in itertools.groupby(self.indices[dy::self.height]):
+            end = start + sum(1 for _ in group)
+            runs.append((start, end - 1, self.palette[index]))
+            start = end
+        return runs
+
+    def comparable(self, other):
+        """True if equal row_key()s mean equal rows in both regions."""
+        return (type(other) is Region and
+                memoryview(self.indices).format ==
+                memoryview(other.indices).format and
+                self.palette[:len(other.palette)] ==
+                other.palette[:len(self.palette)])
+
+    @property
+    def nbytes(self):
+        return memoryview(self.indices).nbytes
+
+
+def changed_runs(old, new):
+    """The (x0, x1, color) runs where row runs new differ from old."""
+    changes = []
+    i = j = start = 0
+    while i < len(old) and j < len(new):
+        end = min(old[i][1], new[j][1])
+        color = new[j][2]
+        if old[i][2] != color:
+            if (changes and changes[-1][1] == start - 1 and
+                    changes[-1][2] == color):
+                changes[-1] = (changes[-1][0], end, color)
+            else:
+                changes.append((start, end, color))
+        start = end + 1
+        i += old[i][1] == end
+        j += new[j][1] == end
+    return changes
+
+
+PATCH_HEADER = struct.Struct("<4sIIHI")  # Magic, width, height, colors, runs
+PATCH_RUN = struct.Struct("<IIIB")  # Row, first column, length, color
+
+
+@functools.lru_cache(maxsize=None)
+def html_cell(color):
+    name = color if not color.startswith("light") else color[5:]
+    char = (name[0].upper() if color != "white" else
+            '<font color="white">X</font>')
+    return '<td style="background-color: {}">{}</td>'.format(
+        color if color != "red" else "pink", char)
+
 
 class Grid:
 
     def __init__(self, width, height):
+        self.__html_rows = {}  # Row -> rendered HTML, dropped when changed
+        self._create_cells(width, height)
+
+    def _create_cells(self, width, height):
         self.__cells = [["white" for _ in range(height)]
                         for _ in range(width)]
 
@@ -50,6 +289,148 @@ class Grid:
             return self.__cells[x][y]
 
         self.__cells[x][y] = color
+        self.__html_rows.pop(y, None)
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        height = y1 - y0 + 1
+        for column in self.__cells[x0:x1 + 1]:
+            column[y0:y1 + 1] = [color] * height
+        self._changed(y0, y1)
+
+    def copy_region(self, x0, y0, x1, y1):
+        columns = self.__cells[x0:x1 + 1]
+        for typecode in "BH":
+            palette = {}
+            indices = array(typecode)
+            try:
+                for column in columns:
+                    indices.extend(palette.setdefault(color, len(palette))
+                                   for color in column[y0:y1 + 1])
+            except OverflowError:  # More than 256 distinct colors
+                continue
+            return Region(x1 - x0 + 1, y1 - y0 + 1, tuple(palette), indices)
+        raise ValueError("Too many distinct colors in region")
+
+    def paste_region(self, x0, y0, region):
+        for dx in range(region.width):
+            self.__cells[x0 + dx][y0:y0 + region.height] = region.column(dx)
+        self._changed(y0, y0 + region.height - 1)
+
+    def count_color(self, color):
+        return sum(column.count(color) for column in self.__cells)
+
+    def flood_fill(self, x, y, color):
+        """
+        Repaint the area of same-colored cells around (x, y), one column
+        span at a time, without recursion. Return the replaced color and
+        the filled spans as a flat array of (x, y0, y1) triples.
+        """
+        target = self.cell(x, y)
+        spans = array("l")
+        if target == color:
+            return target, spans
+
+        cell = self.cell
+        columns, last_row = self.columns, self.rows - 1
+        seeds = [(x, y)]
+        while seeds:
+            x, y = seeds.pop()
+            if cell(x, y) != target:
+                continue
+            y0 = y1 = y
+            while y0 > 0 and cell(x, y0 - 1) == target:
+                y0 -= 1
+            while y1 < last_row and cell(x, y1 + 1) == target:
+                y1 += 1
+            self.fill_rect(x, y0, x, y1, color)
+            spans.extend((x, y0, y1))
+            for next_x in (x - 1, x + 1):
+                if 0 <= next_x < columns:
+                    inside = False
+                    for next_y in range(y0, y1 + 1):
+                        if cell(next_x, next_y) != target:
+                            inside = False
+                        elif not inside:
+                            seeds.append((next_x, next_y))
+                            inside = True
+        return target, spans
+
+    def snapshot(self):
+        return self.copy_region(0, 0, self.columns - 1, self.rows - 1)
+
+    def diff(self, snapshot):
+        """
+        Return a binary patch that turns the grid state saved by snapshot()
+        into the current one: a palette followed by one (row, first column,
+        length, palette index) record per changed run.
+        """
+        current = self.snapshot()
+        comparable = current.comparable(snapshot)
+        palette = {}
+        runs = []
+        for y in range(current.height):
+            if comparable and current.row_key(y) == snapshot.row_key(y):
+                continue
+            for x0, x1, color in changed_runs(snapshot.row_runs(y),
+                                              current.row_runs(y)):
+                runs.append(PATCH_RUN.pack(
+                    y, x0, x1 - x0 + 1,
+                    palette.setdefault(color, len(palette))))
+        if len(palette) > 256:
+            raise ValueError("Too many distinct colors in patch")
+
+        names = [color.encode() for color in palette]
+        return b"".join([
+            PATCH_HEADER.pack(b"GRID", self.columns, self.rows,
+                              len(names), len(runs)),
+            *(bytes((len(name),)) + name for name in names), *runs])
+
+    def apply_patch(self, patch):
+        """
+        Apply a patch made by diff(). A patch that is truncated, for another
+        grid size or not a patch at all raises ValueError before any cell
+        is changed.
+        """
+        if len(patch) < PATCH_HEADER.size:
+            raise ValueError("Patch is truncated")
+        magic, width, height, colors, count = PATCH_HEADER.unpack_from(patch)
+        if magic != b"GRID":
+            raise ValueError("Not a grid patch")
+        if (width, height) != (self.columns, self.rows):
+            raise ValueError("Patch is for a {}x{} grid".format(width, height))
+
+        offset = PATCH_HEADER.size
+        palette = []
+        for _ in range(colors):
+            if offset >= len(patch) or offset + 1 + patch[offset] > len(patch):
+                raise ValueError("Patch is truncated")
+            size = patch[offset]
+            palette.append(patch[offset + 1:offset + 1 + size].decode())
+            offset += 1 + size
+        if len(patch) - offset != count * PATCH_RUN.size:
+            raise ValueError("Patch has {} bytes of runs, expected {}".format(
+                len(patch) - offset, count * PATCH_RUN.size))
+        runs = list(PATCH_RUN.iter_unpack(memoryview(patch)[offset:]))
+        for y, x0, length, index in runs:
+            if (y >= height or length == 0 or x0 + length > width or
+                    index >= len(palette)):
+                raise ValueError("Patch run ({}, {}, {}, {}) is out of "
+                                 "range".format(y, x0, length, index))
+
+        # Runs repeated on consecutive rows are painted as one rectangle
+        rectangle = None
+        for y, x0, length, index in runs:
+            if (rectangle is not None and rectangle[3] == y - 1 and
+                    rectangle[0] == x0 and
+                    rectangle[2] == x0 + length - 1 and
+                    rectangle[4] == palette[index]):
+                rectangle[3] = y
+                continue
+            if rectangle is not None:
+                self.fill_rect(*rectangle)
+            rectangle = [x0, y, x0 + length - 1, y, palette[index]]
+        if rectangle is not None:
+            self.fill_rect(*rectangle)
 
     @property
     def rows(self):
@@ -59,24 +440,321 @@ class Grid:
     def columns(self):
         return len(self.__cells)
 
-    def as_html(self, description=None):
-        table = ['<table border="1" style="font-family: fixed">']
+    def _row(self, y, x0, x1):
+        """Colors of row y from column x0 to x1."""
+        return [column[y] for column in self.__cells[x0:x1 + 1]]
+
+    def _changed(self, y0, y1):
+        """Forget the rendered HTML of rows y0..y1."""
+        if y0 == 0 and y1 == self.rows - 1:
+            self.__html_rows.clear()
+            return
+        for y in range(y0, y1 + 1):
+            self.__html_rows.pop(y, None)
+
+    def __html(self, description, window, cache=True):
+        x0, y0, x1, y1 = window or (0, 0, self.columns - 1, self.rows - 1)
+        yield '<table border="1" style="font-family: fixed">'
         if description is not None:
-            table.append('<tr><td colspan="{}">{}</td></tr>'.format(
-                self.columns, description))
-
-        for y in range(self.rows):
-            table.append("<tr>")
-            for x in range(self.columns):
-                color = self.__cells[x][y]
-                name = color if not color.startswith("light") else color[5:]
-                char = (name[0].upper() if color != "white" else
-                        '<font color="white">X</font>')
-                table.append('<td style="background-color: {}">{}</td>'.
-                             format(color if color != "red" else "pink", char))
-            table.append("</tr>")
-        table.append("</table>")
-        return "\n".join(table)
+            yield '<tr><td colspan="{}">{}</td></tr>'.format(
+                x1 - x0 + 1, description)
+
+        for y in range(y0, y1 + 1):
+            cached = self.__html_rows.get(y)
+            if cached is not None and cached[:2] == (x0, x1):
+                yield cached[2]
+                continue
+            row = "\n".join(
+                ["<tr>", *map(html_cell, self._row(y, x0, x1)), "</tr>"])
+            if cache:
+                self.__html_rows[y] = (x0, x1, row)
+            yield row
+        yield "</table>"
+
+    def as_html(self, description=None, window=None):
+        """
+        Render the grid, or only the (x0, y0, x1, y1) window of it, as an
+        HTML table.
+        """
+        return "\n".join(self.__html(description, window))
+
+    def write_html(self, file, description=None, window=None):
+        """
+        Same output as as_html(), written row by row to file. Rows are
+        taken from the cache of as_html() but not added to it, so the
+        whole table is never held in memory.
+        """
+        lines = self.__html(description, window, cache=False)
+        file.write(next(lines))
+        for line in lines:
+            file.write("\n")
+            file.write(line)
+
+
+class PaletteGrid(Grid):
+    """
+    Grid stored as one bytearray of palette indices, column by column, so
+    a cell costs a byte and rectangle operations become slice assignments.
+    At most 256 distinct colors can be used.
+    """
+
+    def _create_cells(self, width, height):
+        self.__width = width
+        self.__height = height
+        self.__palette = ["white"]
+        self.__indices = {"white": 0}
+        self.__palette_lock = threading.Lock()
+        self.__cells = bytearray(width * height)
+
+    def __index(self, color):
+        index = self.__indices.get(color)
+        if index is None:
+            with self.__palette_lock:
+                index = self.__indices.get(color)
+                if index is None:
+                    if len(self.__palette) == 256:
+                        raise ValueError("Palette is full, can't add {}".
+                                         format(color))
+                    index = len(self.__palette)
+                    self.__palette.append(color)
+                    self.__indices[color] = index
+        return index
+
+    def cell(self, x, y, color=None):
+        if not (0 <= x < self.__width and 0 <= y < self.__height):
+            raise IndexError("Cell ({}, {}) is outside the grid".format(x, y))
+        offset = x * self.__height + y
+        if color is None:
+            return self.__palette[self.__cells[offset]]
+
+        self.__cells[offset] = self.__index(color)
+        self._changed(y, y)
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        value = bytes((self.__index(color),))
+        if y0 == 0 and y1 == self.__height - 1:  # Whole columns: one slice
+            start, stop = x0 * self.__height, (x1 + 1) * self.__height
+            self.__cells[start:stop] = value * (stop - start)
+            self._changed(y0, y1)
+            return
+
+        height = y1 - y0 + 1
+        value *= height
+        for start in range(x0 * self.__height + y0,
+                           x1 * self.__height + y0 + 1, self.__height):
+            self.__cells[start:start + height] = value
+        self._changed(y0, y1)
+
+    def copy_region(self, x0, y0, x1, y1):
+        height = y1 - y0 + 1
+        if height == self.__height:
+            indices = self.__cells[x0 * height:(x1 + 1) * height]
+        else:
+            cells = memoryview(self.__cells)
+            indices = bytearray().join(
+                cells[start:start + height]
+                for start in range(x0 * self.__height + y0,
+                                   x1 * self.__height + y0 + 1, self.__height))
+        return Region(x1 - x0 + 1, height, tuple(self.__palette), indices)
+
+    def paste_region(self, x0, y0, region):
+        indices = region.indices
+        palette = region.palette
+        if (memoryview(indices).itemsize != 1 or
+                tuple(self.__palette[:len(palette)]) != palette):
+            table = [self.__index(color) for color in palette]
+            indices = bytes(table[i] for i in indices)
+
+        indices = memoryview(indices)
+        height = region.height
+        for dx in range(region.width):
+            start = (x0 + dx) * self.__height + y0
+            self.__cells[start:start + height] = \
+                indices[dx * height:(dx + 1) * height]
+        self._changed(y0, y0 + height - 1)
+
+    def count_color(self, color):
+        index = self.__indices.get(color)
+        return 0 if index is None else self.__cells.count(index)
+
+    @property
+    def rows(self):
+        return self.__height
+
+    @property
+    def columns(self):
+        return self.__width
+
+    def _row(self, y, x0, x1):
+        return [self.__palette[i] for i in self.__cells[
+            x0 * self.__height + y:x1 * self.__height + y + 1:self.__height]]
+
+
+class RunRegion:
+    """
+    Before-image of a block of a SparseGrid: for each non-empty row of the
+    block, its (dx0, dx1, color) runs relative to the block origin.
+    """
+
+    __slots__ = ("width", "height", "runs")
+
+    def __init__(self, width, height, runs):
+        self.width = width
+        self.height = height
+        self.runs = runs
+
+    def row_key(self, dy):
+        return self.runs.get(dy)
+
+    def row_runs(self, dy):
+        runs = []
+        start = 0
+        for dx0, dx1, color in self.runs.get(dy, ()):
+            if dx0 > start:
+                runs.append((start, dx0 - 1, "white"))
+            runs.append((dx0, dx1, color))
+            start = dx1 + 1
+        if start < self.width:
+            runs.append((start, self.width - 1, "white"))
+        return runs
+
+    def comparable(self, other):
+        return type(other) is RunRegion
+
+    @property
+    def nbytes(self):
+        return sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+                   for row in self.runs.values())
+
+
+class SparseGrid(Grid):
+    """
+    Grid that stores only the non-white cells, as runs: for each painted
+    row a sorted list of run starts plus a parallel list of (end, color).
+    Memory is proportional to the painted runs, and cell() is a dict
+    lookup plus a bisect over the runs of one row.
+    """
+
+    def _create_cells(self, width, height):
+        self.__width = width
+        self.__height = height
+        self.__rows = {}  # y -> ([x0, ...], [(x1, color), ...])
+
+    def cell(self, x, y, color=None):
+        if not (0 <= x < self.__width and 0 <= y < self.__height):
+            raise IndexError("Cell ({}, {}) is outside the grid".format(x, y))
+        if color is not None:
+            self.__paint(y, x, x, color)
+            self._changed(y, y)
+            return
+
+        row = self.__rows.get(y)
+        if row is not None:
+            starts, runs = row
+            i = bisect.bisect_right(starts, x) - 1
+            if i >= 0 and runs[i][0] >= x:
+                return runs[i][1]
+        return "white"
+
+    def __paint(self, y, x0, x1, color):
+        row = self.__rows.get(y)
+        if row is None:
+            if color == "white":
+                return
+            row = self.__rows[y] = ([], [])
+        starts, runs = row
+
+        # Runs lo..hi-1 overlap or touch x0..x1
+        lo = bisect.bisect_right(starts, x0) - 1
+        if lo < 0 or runs[lo][0] < x0 - 1:
+            lo += 1
+        hi = bisect.bisect_right(starts, x1 + 1)
+
+        pieces = [(x0, x1, color)]
+        if lo < hi:
+            if starts[lo] < x0:
+                pieces.insert(0, (starts[lo], min(runs[lo][0], x0 - 1),
+                                  runs[lo][1]))
+            if runs[hi - 1][0] > x1:
+                pieces.append((max(starts[hi - 1], x1 + 1), runs[hi - 1][0],
+                               runs[hi - 1][1]))
+        merged = []
+        for piece in pieces:
+            if merged and merged[-1][2] == piece[2]:
+                merged[-1] = (merged[-1][0], piece[1], piece[2])
+            else:
+                merged.append(piece)
+        merged = [piece for piece in merged if piece[2] != "white"]
+
+        starts[lo:hi] = [start for start, _, _ in merged]
+        runs[lo:hi] = [(end, color) for _, end, color in merged]
+        if not starts:
+            del self.__rows[y]
+
+    def __runs(self, y, x0, x1):
+        """The (start, end, color) runs of row y clipped to x0..x1."""
+        row = self.__rows.get(y)
+        if row is None:
+            return []
+        starts, runs = row
+        lo = max(bisect.bisect_right(starts, x0) - 1, 0)
+        hi = bisect.bisect_right(starts, x1)
+        return [(max(start, x0), min(end, x1), color)
+                for start, (end, color) in zip(starts[lo:hi], runs[lo:hi])
+                if end >= x0]
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        for y in range(y0, y1 + 1):
+            self.__paint(y, x0, x1, color)
+        self._changed(y0, y1)
+
+    def copy_region(self, x0, y0, x1, y1):
+        if y1 - y0 + 1 > len(self.__rows):
+            ys = sorted(y for y in self.__rows if y0 <= y <= y1)
+        else:
+            ys = [y for y in range(y0, y1 + 1) if y in self.__rows]
+        runs = {}
+        for y in ys:
+            row = [(start - x0, end - x0, color)
+                   for start, end, color in self.__runs(y, x0, x1)]
+            if row:
+                runs[y - y0] = row
+        return RunRegion(x1 - x0 + 1, y1 - y0 + 1, runs)
+
+    def paste_region(self, x0, y0, region):
+        x1 = x0 + region.width - 1
+        for dy in range(region.height):
+            self.__paint(y0 + dy, x0, x1, "white")
+        for dy, row in region.runs.items():
+            for dx0, dx1, color in row:
+                self.__paint(y0 + dy, x0 + dx0, x0 + dx1, color)
+        self._changed(y0, y0 + region.height - 1)
+
+    def count_color(self, color):
+        painted = 0
+        count = 0
+        for starts, runs in self.__rows.values():
+            for start, (end, run_color) in zip(starts, runs):
+                painted += end - start + 1
+                if run_color == color:
+                    count += end - start + 1
+        if color == "white":
+            return self.__width * self.__height - painted
+        return count
+
+    @property
+    def rows(self):
+        return self.__height
+
+    @property
+    def columns(self):
+        return self.__width
+
+    def _row(self, y, x0, x1):
+        row = ["white"] * (x1 - x0 + 1)
+        for start, end, color in self.__runs(y, x0, x1):
+            row[start - x0:end - x0 + 1] = [color] * (end - start + 1)
+        return row
 
 
 class UndoableGrid(Grid):
@@ -90,18 +768,503 @@ class UndoableGrid(Grid):
             undo.color = self.cell(x, y) # Subtle!
             self.cell(x, y, color)
 
-        return Command.Command(do, undo, "Cell")
+        return Command(do, undo, "Cell", (self, x, y, x, y, color))
 
     def create_rectangle_macro(self, x0, y0, x1, y1, color):
-        macro = Command.Macro("Rectangle")
+        macro = Macro("Rectangle")
         for x in range(x0, x1 + 1):
             for y in range(y0, y1 + 1):
                 macro.add(self.create_cell_command(x, y, color))
 
         return macro
 
+    def create_rectangle_command(self, x0, y0, x1, y1, color):
+        """
+        Same effect as create_rectangle_macro(), but the whole block is one
+        Command whose undo data is a single compact Region.
+        """
+        before = None
+
+        def undo():
+            self.paste_region(x0, y0, before)
+
+        def do():
+            nonlocal before
+            before = self.copy_region(x0, y0, x1, y1)
+            self.fill_rect(x0, y0, x1, y1, color)
+
+        def forget():
+            nonlocal before
+            before = None
+
+        return Command(do, undo, "Rectangle", (self, x0, y0, x1, y1, color),
+                       forget)
+
+    def create_flood_fill_command(self, x, y, color):
+        """
+        Flood fill from (x, y). The undo data is the replaced color and the
+        filled column spans, so undo repaints spans instead of cells.
+        """
+        target = spans = None
+
+        def undo():
+            for i in range(0, len(spans), 3):
+                self.fill_rect(spans[i], spans[i + 1], spans[i], spans[i + 2],
+                               target)
+
+        def do():
+            nonlocal target, spans
+            target, spans = self.flood_fill(x, y, color)
+
+        def forget():
+            nonlocal target, spans
+            target = spans = None
+
+        return Command(do, undo, "Flood Fill", forget=forget)
+
+
+class History:
+    """
+    Undo history with a bounded footprint. Every `checkpoint_every`
+    commands the whole grid is saved as one compact region and the undo
+    data of the commands before it is forgotten; undoing past a checkpoint
+    restores the nearest earlier one and replays the commands after it.
+    Once the checkpoints take more than `max_bytes` the oldest ones, and
+    the commands before them, are dropped and can no longer be undone.
+    """
+
+    def __init__(self, grid, checkpoint_every=100, max_bytes=64 * 2 ** 20):
+        self.__grid = grid
+        self.__checkpoint_every = checkpoint_every
+        self.__max_bytes = max_bytes
+        self.__commands = []
+        self.__first = 0  # Number of the oldest command still kept
+        self.__checkpoints = []  # (commands done, grid region) pairs
+        self.__live = 0  # Commands from this number on still have undo data
+        self.__checkpoint()
+
+    def __len__(self):
+        """Number of commands that can still be undone."""
+        return len(self.__commands)
+
+    @property
+    def nbytes(self):
+        return sum(region.nbytes for _, region in self.__checkpoints)
+
+    def execute(self, command):
+        command.do()
+        self.__commands.append(command)
+        if (self.__first + len(self.__commands)) % \
+                self.__checkpoint_every == 0:
+            self.__checkpoint()
+
+    def undo(self):
+        if not self.__commands:
+            raise IndexError("Nothing to undo")
+        command = self.__commands.pop()
+        done = self.__first + len(self.__commands)
+        while self.__checkpoints[-1][0] > done:
+            self.__checkpoints.pop()
+
+        if done >= self.__live:
+            command.undo()
+            return
+
+        restored, region = self.__checkpoints[-1]
+        self.__grid.paste_region(0, 0, region)
+        for command in self.__commands[restored - self.__first:]:
+            command.do()
+        self.__live = restored
+
+    def __checkpoint(self):
+        grid = self.__grid
+        done = self.__first + len(self.__commands)
+        self.__checkpoints.append(
+            (done, grid.copy_region(0, 0, grid.columns - 1, grid.rows - 1)))
+        for command in self.__commands[self.__live - self.__first:]:
+            command.forget()
+        self.__live = done
+
+        while len(self.__checkpoints) > 1 and self.nbytes > self.__max_bytes:
+            del self.__checkpoints[0]
+            oldest = self.__checkpoints[0][0]
+            del self.__commands[:oldest - self.__first]
+            self.__first = oldest
+
+
+class UndoablePaletteGrid(UndoableGrid, PaletteGrid):
+    """UndoableGrid commands on top of the PaletteGrid storage."""
+
+
+class UndoableSparseGrid(UndoableGrid, SparseGrid):
+    """UndoableGrid commands on top of the SparseGrid storage."""
+
+
+class ConcurrentGrid:
+    """
+    Mixin for grids edited from several threads. Rows are split into
+    `bands`, each with its own lock, and an edit only locks the bands of
+    the rows it changes, always in top to bottom order so that edits can't
+    deadlock. Reads lock the bands they read too, so they never see an
+    edit half done; hold locked() to read several cells consistently.
+    Edits of different bands run in parallel on a free-threaded Python
+    build.
+    """
+
+    def __init__(self, width, height, bands=64):
+        self.__band_height = max(1, -(-height // bands))
+        self.__locks = [threading.RLock()
+                        for _ in range(0, height, self.__band_height)]
+        super().__init__(width, height)
+
+    @contextlib.contextmanager
+    def locked(self, y0=0, y1=None):
+        """Hold the locks of rows y0..y1, by default of the whole grid."""
+        if y1 is None:
+            y1 = self.rows - 1
+        locks = self.__locks[y0 // self.__band_height:
+                             y1 // self.__band_height + 1]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def commit(self, macro, undo=False):
+        """
+        Run macro (or its undo) while holding every band it paints, so other
+        threads never see it half done. Commands without writes metadata
+        lock the whole grid.
+        """
+        rows = [command.writes[2:5:2] if command.writes is not None else
+                (0, self.rows - 1) for command in macro]
+        with self.locked(min(rows)[0] if rows else 0,
+                         max(y1 for _, y1 in rows) if rows else 0):
+            macro.undo() if undo else macro.do()
+
+    def cell(self, x, y, color=None):
+        with self.__locks[y // self.__band_height]:
+            return super().cell(x, y, color)
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        with self.locked(y0, y1):
+            super().fill_rect(x0, y0, x1, y1, color)
+
+    def copy_region(self, x0, y0, x1, y1):
+        with self.locked(y0, y1):
+            return super().copy_region(x0, y0, x1, y1)
+
+    def paste_region(self, x0, y0, region):
+        with self.locked(y0, y0 + region.height - 1):
+            super().paste_region(x0, y0, region)
+
+    def flood_fill(self, x, y, color):
+        with self.locked():
+            return super().flood_fill(x, y, color)
+
+    def count_color(self, color):
+        with self.locked():
+            return super().count_color(color)
+
+    def snapshot(self):
+        with self.locked():
+            return super().snapshot()
+
+    def diff(self, snapshot):
+        with self.locked():
+            return super().diff(snapshot)
+
+    def apply_patch(self, patch):
+        with self.locked():
+            super().apply_patch(patch)
+
+    def as_html(self, description=None, window=None):
+        with self.locked():
+            return super().as_html(description, window)
+
+    def write_html(self, file, description=None, window=None):
+        with self.locked():
+            super().write_html(file, description, window)
+
+
+class ConcurrentUndoableGrid(ConcurrentGrid, UndoableGrid):
+    """UndoableGrid safe to edit from several threads."""
+
+
+class ConcurrentUndoablePaletteGrid(ConcurrentGrid, UndoablePaletteGrid):
+    """UndoablePaletteGrid safe to edit from several threads."""
+
+
+def measure(action):
+    """Run action() and return (seconds, peak traced bytes, result)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = action()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def benchmark_rectangle(size=500):
+    print("Rectangle {0}x{0}: per-cell Macro vs region Command".format(size))
+    for name in ("create_rectangle_macro", "create_rectangle_command"):
+        grid = UndoableGrid(size, size)
+
+        def paint():
+            command = getattr(grid, name)(0, 0, size - 1, size - 1, "red")
+            command.do()
+            return command
+
+        elapsed, peak, command = measure(paint)
+        start = time.perf_counter()
+        command.undo()
+        undo_elapsed = time.perf_counter() - start
+        assert grid.cell(size - 1, size - 1) == "white"
+        print("  {:<26} do {:7.3f}s  undo {:7.3f}s  peak {:9.1f} MB".format(
+            name, elapsed, undo_elapsed, peak / 2 ** 20))
+
+
+def benchmark_palette(size=2000):
+    print("Batch recolor {0}x{0}: Grid vs PaletteGrid".format(size))
+    for Class in (Grid, PaletteGrid):
+        elapsed, peak, grid = measure(lambda: Class(size, size))
+
+        def recolor():
+            for i in range(0, size // 2, 10):
+                grid.fill_rect(i, i, size - i - 1, size - i - 1,
+                               "red" if i % 20 else "lightblue")
+            return grid.count_color("red")
+
+        start = time.perf_counter()
+        red = recolor()
+        recolor_elapsed = time.perf_counter() - start
+        print("  {:<12} create {:6.3f}s {:7.1f} MB  recolor {:6.3f}s "
+              "({} red)".format(Class.__name__, elapsed, peak / 2 ** 20,
+                                recolor_elapsed, red))
+
+
+def benchmark_snapshots(size=300, edits=200):
+    print("{} snapshots of a {}x{} grid, one cell edit apart".format(
+        edits, size, size))
+    for cached in (False, True):
+        grid = UndoableGrid(size, size)
+        start = time.perf_counter()
+        for i in range(edits):
+            grid.create_cell_command(i % size, (i * 7) % size, "red")()
+            if not cached:
+                grid._changed(0, size - 1)  # Full re-render, as before
+            grid.as_html(str(i))
+        print("  {:<10} {:7.3f}s".format(
+            "cached" if cached else "uncached", time.perf_counter() - start))
+
+
+def benchmark_sparse(size=100000):
+    print("SparseGrid {0}x{0}: memory vs painted rectangles".format(size))
+    grid = UndoableSparseGrid(size, size)
+    commands = []
+    for count in (10, 100, 1000):
+        def paint():
+            while len(commands) < count:
+                i = len(commands)
+                x, y = (i * 7919) % (size - 100), (i * 104729) % (size - 100)
+                commands.append(grid.create_rectangle_command(
+                    x, y, x + 99, y + 9, "red" if i % 2 else "lightblue"))
+                commands[-1]()
+
+        tracemalloc.start()
+        paint()
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("  {:5} rectangles {:9} cells {:7.2f} MB".format(
+            count, size * size - grid.count_color("white"),
+            current / 2 ** 20))
+    grid.as_html("Viewport", window=(0, 0, 39, 19))
+    for command in reversed(commands):
+        command.undo()
+    assert grid.count_color("white") == size * size
+
+
+def benchmark_flood_fill(size=1000):
+    print("Flood fill of a {0}x{0} maze: per-cell Macro vs span Command".
+          format(size))
+    grid = UndoablePaletteGrid(size, size)
+
+    def paint_maze():
+        grid.fill_rect(0, 0, size - 1, size - 1, "white")
+        for x in range(3, size, 4):  # Walls with a gap at alternating ends
+            grid.fill_rect(x, 0, x, size - 1, "black")
+            grid.cell(x, 0 if x % 8 == 3 else size - 1, "white")
+
+    paint_maze()
+    _, spans = grid.flood_fill(0, 0, "red")
+    paint_maze()
+
+    def per_cell():
+        macro = Macro("Fill Area")
+        for i in range(0, len(spans), 3):
+            for y in range(spans[i + 1], spans[i + 2] + 1):
+                macro.add(grid.create_cell_command(spans[i], y, "red"))
+        macro()
+        return macro
+
+    def span_fill():
+        command = grid.create_flood_fill_command(0, 0, "red")
+        command()
+        return command
+
+    for name, action in (("per-cell Macro", per_cell),
+                         ("flood fill Command", span_fill)):
+        elapsed, peak, command = measure(action)
+        filled = grid.count_color("red")
+        start = time.perf_counter()
+        command.undo()
+        undo_elapsed = time.perf_counter() - start
+        assert grid.count_color("red") == 0
+        print("  {:<20} {} cells  do {:7.3f}s  undo {:7.3f}s  "
+              "peak {:8.1f} MB".format(name, filled, elapsed, undo_elapsed,
+                                       peak / 2 ** 20))
+
+
+def benchmark_compile(size=200, replays=5):
+    print("Replaying a scripted {0}x{0} macro {1} times: plain vs compiled".
+          format(size, replays))
+    grid = UndoableGrid(size, size)
+    macro = Macro("Script")
+    for i in range(0, size, 5):
+        for x in range(i, size):
+            for y in range(i, min(i + 20, size)):
+                macro.add(grid.create_cell_command(
+                    x, y, "red" if i % 2 else "lightblue"))
+    results = []
+    for name, replayed in (("plain", macro), ("compiled", macro.compile())):
+        start = time.perf_counter()
+        for _ in range(replays):
+            replayed()
+            replayed.undo()
+        print("  {:<10} {:7.3f}s".format(name, time.perf_counter() - start))
+        replayed()
+        results.append(grid.as_html())
+        replayed.undo()
+        assert grid.count_color("white") == size * size
+    assert results[0] == results[1]
+
+
+def benchmark_history(size=200, edits=5000):
+    print("{} rectangle edits on a {}x{} grid: unbounded vs History".format(
+        edits, size, size))
+    for bounded in (False, True):
+        grid = UndoablePaletteGrid(size, size)
+        history = (History(grid, checkpoint_every=100, max_bytes=2 ** 20)
+                   if bounded else None)
+        commands = []
+
+        def edit():
+            for i in range(edits):
+                x, y = (i * 37) % (size - 50), (i * 91) % (size - 50)
+                command = grid.create_rectangle_command(
+                    x, y, x + 49, y + 49, "red" if i % 2 else "lightblue")
+                if bounded:
+                    history.execute(command)
+                else:
+                    command()
+                    commands.append(command)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        edit()
+        elapsed = time.perf_counter() - start
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for _ in range(250):
+            if bounded:
+                history.undo()
+            else:
+                commands.pop().undo()
+        print("  {:<10} edits {:6.3f}s  kept {:7.2f} MB  250 undos "
+              "{:6.3f}s".format("History" if bounded else "unbounded",
+                                elapsed, current / 2 ** 20,
+                                time.perf_counter() - start))
+
+
+def benchmark_patch(size=1000, macros=20):
+    print("Syncing a {0}x{0} grid after each of {1} macros: "
+          "as_html vs patch".format(size, macros))
+    grid = UndoablePaletteGrid(size, size)
+    replica = PaletteGrid(size, size)
+    html_bytes = html_time = patch_bytes = patch_time = 0
+    for i in range(macros):
+        snapshot = grid.snapshot()
+        macro = Macro("Edit")
+        x, y = (i * 97) % (size - 40), (i * 53) % (size - 40)
+        macro.add(grid.create_rectangle_command(x, y, x + 39, y + 19, "red"))
+        macro.add(grid.create_cell_command(x + 39, y + 39, "lightblue"))
+        macro()
+
+        start = time.perf_counter()
+        html_bytes += len(grid.as_html().encode())
+        html_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        patch = grid.diff(snapshot)
+        replica.apply_patch(patch)
+        patch_time += time.perf_counter() - start
+        patch_bytes += len(patch)
+    assert replica.as_html() == grid.as_html()
+    print("  {:<8} {:11} bytes {:7.3f}s".format("as_html", html_bytes,
+                                                html_time))
+    print("  {:<8} {:11} bytes {:7.3f}s".format("patch", patch_bytes,
+                                                patch_time))
+
+
+def benchmark_threads(size=512, edits=2000):
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("{} rectangle macros per thread on a {}x{} grid (GIL {})".format(
+        edits, size, size, "enabled" if gil else "disabled"))
+    for bands in (1, 64):
+        for threads in (1, 2, 4, 8):
+            grid = ConcurrentUndoablePaletteGrid(size, size, bands=bands)
+            band = size // threads
+
+            def work(n):
+                for i in range(edits):
+                    y = n * band + (i * 7) % (band - 4)
+                    x = (i * 13) % (size - 16)
+                    macro = Macro("Edit")
+                    macro.add(grid.create_rectangle_command(
+                        x, y, x + 15, y + 3, "red" if i % 2 else "lightblue"))
+                    macro.add(grid.create_cell_command(x, y, "black"))
+                    grid.commit(macro)
+                    if i % 4 == 0:
+                        grid.commit(macro, undo=True)
+
+            workers = [threading.Thread(target=work, args=(n,))
+                       for n in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            print("  {:2} band(s) {} thread(s) {:9.0f} macros/s".format(
+                bands, threads, threads * edits / elapsed))
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-B":  # Benchmarks
+        benchmark_rectangle()
+        benchmark_palette()
+        benchmark_snapshots()
+        benchmark_sparse()
+        benchmark_flood_fill()
+        benchmark_compile()
+        benchmark_history()
+        benchmark_patch()
+        benchmark_threads()
+        return
     html = []
     grid = UndoableGrid(8, 3)   # (1) Empty
     html.append(grid.as_html("(1) Empty"))
@@ -114,7 +1277,7 @@ def main():
     green_left()                 # (3) Do Green Cell
     html.append(grid.as_html("(3) Do Green Cell"))
     rectangle_left = grid.create_rectangle_macro(1, 1, 2, 2, "lightblue")
-    rectangle_right = grid.create_rectangle_macro(5, 0, 6, 1, "lightblue")
+    rectangle_right = grid.create_rectangle_command(5, 0, 6, 1, "lightblue")
     rectangle_left()             # (4) Do Blue Squares
     rectangle_right.do()         # OR: rectangle_right()
     html.append(grid.as_html("(4) Do Blue Squares"))
@@ -10,6 +10,12 @@ EXAMPLE - https://github.com/pkolt/design_patterns/blob/master/behavior/command.
 а также поддерживать отмену операций.
 """
 import abc
+import asyncio
+import heapq
+import itertools
+import random
+import sys
+import time
 
 from datetime import datetime
 
@@ -59,12 +65,175 @@ class Switch:
         self.off_cmd.execute()
 
 
+class Scheduler:
+    """
+    Планировщик команд: выполняет команды в заданное время.
+
+    Записи [время, номер, команда] раскладываются по корзинам-интервалам
+    длиной `resolution` секунд, как в колесе таймеров; в куче лежат только
+    номера непустых интервалов. Поэтому schedule и cancel стоят O(1) (плюс
+    O(log) на новый интервал), а run_pending() забирает наступившие
+    интервалы целиком и выполняет их команды одной пачкой. Отменённая
+    запись только помечается и пропускается при выполнении.
+    """
+
+    def __init__(self, resolution=0.01, clock=time.monotonic):
+        self._resolution = resolution
+        self._clock = clock
+        self._slots = {}  # Номер интервала -> записи
+        self._heap = []  # Номера непустых интервалов
+        self._counter = itertools.count()  # Порядок команд с равным временем
+        self._pending = 0
+        self._wakeup = None  # asyncio.Event, пока работает run()
+        self._wake_time = None  # Время, до которого спит run()
+
+    def __len__(self):
+        return self._pending
+
+    def schedule(self, when, command):
+        """Вернуть запись, по которой команду можно отменить."""
+        if command is None:  # None помечает выполненные и отменённые записи
+            raise ValueError("Нет команды для планирования")
+        entry = [when, next(self._counter), command]
+        slot = int(when // self._resolution)
+        entries = self._slots.get(slot)
+        if entries is None:
+            entries = self._slots[slot] = []
+            heapq.heappush(self._heap, slot)
+        entries.append(entry)
+        self._pending += 1
+        if self._wakeup is not None and (self._wake_time is None
+                                         or when < self._wake_time):
+            self._wakeup.set()  # Разбудить run() пораньше
+        return entry
+
+    def cancel(self, entry):
+        """Отменить команду; выполненную или уже отменённую - пропустить."""
+        if entry[-1] is not None:
+            entry[-1] = None
+            self._pending -= 1
+
+    def reschedule(self, entry, when):
+        """Перенести команду записи на время when, вернуть новую запись."""
+        command = entry[-1]
+        if command is None:
+            raise ValueError("Команда уже выполнена или отменена")
+        self.cancel(entry)
+        return self.schedule(when, command)
+
+    def run_pending(self, now=None):
+        """Выполнить все команды со временем <= now, вернуть их число."""
+        if now is None:
+            now = self._clock()
+        current = int(now // self._resolution)
+        executed = 0
+        while self._heap and self._heap[0] <= current:
+            slot = self._heap[0]
+            entries = self._slots[slot]
+            if slot < current:
+                due = entries
+            else:  # Текущий интервал наступил лишь частично
+                due = [entry for entry in entries if entry[0] <= now]
+                entries[:] = [entry for entry in entries if entry[0] > now]
+            if slot < current or not entries:
+                heapq.heappop(self._heap)
+                del self._slots[slot]
+            due.sort()  # By time, then by order of scheduling
+            for entry in due:
+                command = entry[-1]
+                if command is not None:
+                    entry[-1] = None
+                    self._pending -= 1
+                    command.execute()
+                    executed += 1
+            if slot == current:
+                break
+        return executed
+
+    def next_time(self):
+        """Время ближайшей команды или None."""
+        while self._heap:
+            entries = [entry for entry in self._slots[self._heap[0]]
+                       if entry[-1] is not None]
+            if entries:
+                return min(entries)[0]
+            del self._slots[heapq.heappop(self._heap)]
+        return None
+
+    async def run(self):
+        """
+        Выполнять команды по мере наступления их времени, пока они есть.
+        Команда, запланированная во время ожидания на более раннее время,
+        будит run().
+        """
+        self._wakeup = asyncio.Event()
+        try:
+            while self._pending:
+                self.run_pending()
+                when = self.next_time()
+                if when is None:
+                    break
+                self._wake_time = when
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           max(0, when - self._clock()))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = self._wake_time = None
+
+
+def benchmark_scheduler(devices=1000000):
+    class SilentLight:
+        def __init__(self):
+            self.switches = 0
+
+        def turn_on(self):
+            self.switches += 1
+
+        turn_off = turn_on
+
+    print(f'Планирование включения и выключения {devices} светильников')
+    scheduler = Scheduler()
+    lights = [SilentLight() for _ in range(devices)]
+    start = time.perf_counter()
+    entries = [scheduler.schedule(random.random(), TurnOnLightCommand(light))
+               for light in lights]
+    for light in lights:
+        scheduler.schedule(1 + random.random(), TurnOffLightCommand(light))
+    print(f'  schedule:   {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    for entry in entries[::10]:
+        scheduler.reschedule(entry, 0.5 + random.random())
+    for entry in entries[1::10]:
+        scheduler.cancel(entry)
+    print(f'  reschedule/cancel 20%: {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    executed = sum(scheduler.run_pending(now=tick / 100)
+                   for tick in range(1, 201))
+    print(f'  run 200 ticks: {time.perf_counter() - start:.3f}s, '
+          f'{executed} команд')
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-B":  # Benchmarks
+        benchmark_scheduler()
+        return
     light = Light()
     switch = Switch(on_cmd=TurnOnLightCommand(light), off_cmd=TurnOffLightCommand(light))
     switch.on()  # Включить свет
     switch.off()  # Выключить свет
 
+    scheduler = Scheduler()
+    now = time.monotonic()
+    scheduler.schedule(now + 0.2, TurnOffLightCommand(light))
+    entry = scheduler.schedule(now + 0.1, TurnOnLightCommand(light))
+    scheduler.reschedule(entry, now + 0.05)  # Включить пораньше
+    asyncio.run(scheduler.run())  # Включить, затем выключить свет
+
 
 if __name__ == '__main__':
     main()
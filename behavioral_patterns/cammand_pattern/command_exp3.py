@@ -3,7 +3,11 @@
 EXAMPLE - https://sourcemaking.com/design_patterns/command
 """
 import abc
+import asyncio
+import inspect
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 
@@ -14,15 +18,89 @@ class Invoker:
 
     def __init__(self):
         self._commands = []
+        self._positions = {}  # Coalescing key -> index in self._commands
 
     def store_command(self, command):
-        self._commands.append(command)
+        """
+        A command with the same coalescing key as a stored one is merged
+        into it, so each receiver/action pair runs once per flush.
+        """
+        key = command.coalescing_key()
+        if key is None:
+            self._commands.append(command)
+            return
+
+        index = self._positions.get(key)
+        if index is None:
+            self._positions[key] = len(self._commands)
+            self._commands.append(command)
+        else:
+            self._commands[index] = self._commands[index].merge(command)
 
     def execute_commands(self):
         for command in self._commands:
             command.execute()
 
 
+class AsyncInvoker:
+    """
+    Ask the commands to carry out their requests concurrently, at most
+    `concurrency` at a time. Coroutine commands run on the event loop,
+    blocking ones in a thread pool. store_command() waits while
+    `max_pending` commands are already queued.
+    """
+
+    def __init__(self, concurrency=8, max_pending=100):
+        self._concurrency = concurrency
+        self._commands = asyncio.Queue(max_pending)
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._workers = []
+        self.latencies = []  # (command, seconds) in order of completion
+        self.errors = []  # (command, exception)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def store_command(self, command):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work())
+                             for _ in range(self._concurrency)]
+        await self._commands.put(command)
+
+    async def execute_commands(self):
+        """Wait until every stored command has been carried out."""
+        await self._commands.join()
+
+    async def close(self):
+        await self.execute_commands()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._executor.shutdown()
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await self._commands.get()
+            start = time.perf_counter()
+            try:
+                if inspect.iscoroutinefunction(command.execute):
+                    await command.execute()
+                else:
+                    result = await loop.run_in_executor(self._executor,
+                                                        command.execute)
+                    if inspect.isawaitable(result):  # E.g. async __call__
+                        await result
+            except Exception as err:
+                self.errors.append((command, err))
+            self.latencies.append((command, time.perf_counter() - start))
+            self._commands.task_done()
+
+
 class Command(metaclass=abc.ABCMeta):
     """
     Declare an interface for executing an operation.
@@ -35,6 +113,17 @@ class Command(metaclass=abc.ABCMeta):
     def execute(self):
         pass
 
+    def coalescing_key(self):
+        """
+        Commands with the same key do the same thing to the same receiver.
+        None means the command is never coalesced.
+        """
+        return None
+
+    def merge(self, other):
+        """Return one command doing the work of self and then other."""
+        return self
+
 
 class ConcreteCommand(Command):
     """
@@ -47,6 +136,35 @@ class ConcreteCommand(Command):
         self._receiver.action()
 
 
+class AsyncConcreteCommand(Command):
+    """
+    Same binding as ConcreteCommand for a receiver whose action is a
+    coroutine.
+    """
+
+    async def execute(self):
+        await self._receiver.action()
+
+
+class IncrementCommand(Command):
+    """
+    Add `amount` to a Counter. Increments of one counter fold into one.
+    """
+
+    def __init__(self, receiver, amount=1):
+        super().__init__(receiver)
+        self._amount = amount
+
+    def execute(self):
+        self._receiver.increment(self._amount)
+
+    def coalescing_key(self):
+        return type(self), self._receiver
+
+    def merge(self, other):
+        return IncrementCommand(self._receiver, self._amount + other._amount)
+
+
 class Receiver:
     """
     Know how to perform the operations associated with carrying out a
@@ -58,6 +176,42 @@ class Receiver:
         print(f'Do some action - {datetime.now()}')
 
 
+class Counter:
+    """
+    Receiver whose every call is expensive, e.g. a remote counter.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def increment(self, amount):
+        self.value += amount
+        print(f'{self.name} += {amount} -> {self.value}')
+
+
+class AsyncReceiver:
+    """
+    Receiver that waits on I/O without blocking the event loop.
+    """
+
+    @staticmethod
+    async def action():
+        await asyncio.sleep(0.1)
+        print(f'Do some async action - {datetime.now()}')
+
+
+async def async_main():
+    async with AsyncInvoker(concurrency=4, max_pending=2) as invoker:
+        for _ in range(4):
+            await invoker.store_command(ConcreteCommand(Receiver()))
+            await invoker.store_command(
+                AsyncConcreteCommand(AsyncReceiver()))
+        await invoker.execute_commands()
+    for command, seconds in invoker.latencies:
+        print(f'{type(command).__name__}: {seconds * 1000:.1f} ms')
+
+
 def main():
     receiver = Receiver()
     concrete_command = ConcreteCommand(receiver)
@@ -65,6 +219,14 @@ def main():
     invoker.store_command(concrete_command)
     invoker.execute_commands()
 
+    invoker = Invoker()
+    hits, misses = Counter('hits'), Counter('misses')
+    for i in range(10):
+        invoker.store_command(IncrementCommand(misses if i % 3 else hits))
+    invoker.execute_commands()  # hits += 4, misses += 6
+
+    asyncio.run(async_main())
+
 
 if __name__ == "__main__":
     main()
@@ -3,7 +3,15 @@
 EXAMPLE - from book "Learning Python Design Patterns"
 """
 import abc
+import json
+import operator
 import os
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Command(metaclass=abc.ABCMeta):
@@ -30,6 +38,14 @@ class TouchCommand(Command):
     def undo(self):
         self.receiver.delete_file()
 
+    def to_record(self):
+        return {'command': type(self).__name__,
+                'file_name': self.receiver.file_name}
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(TouchReceiver(record['file_name']))
+
 
 class TouchReceiver:
     """Do all work of creating and deleting file."""
@@ -39,8 +55,11 @@ class TouchReceiver:
 
     def create_file(self):
         """Actual implementation of Unix touch command."""
-        with open(self.file_name, 'a'):
-            os.utime(self.file_name, None)
+        fd = os.open(self.file_name, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.utime(fd if os.utime in os.supports_fd else self.file_name)
+        finally:
+            os.close(fd)
 
     def delete_file(self):
         """Undo Unix touch command."""
@@ -50,18 +69,30 @@ class TouchReceiver:
 class Invoker:
     """Ask the command to carry out the request."""
 
-    def __init__(self, create_file_commands=None, delete_file_commands=None):
+    def __init__(self, create_file_commands=None, delete_file_commands=None,
+                 journal=None):
         self.create_file_commands = create_file_commands or []
         self.delete_file_commands = delete_file_commands or []
         self.history = []
+        self.journal = journal
+
+    def begin(self, commands, undo=False):
+        """Make the commands about to run (or be undone) durable first."""
+        return self.journal.begin(commands, undo) if self.journal else None
+
+    def commit(self, batch):
+        if self.journal:
+            self.journal.commit(batch)
 
     def create_file(self):
 
         print('Creating file...')
 
+        batch = self.begin(self.create_file_commands)
         for command in self.create_file_commands:
             command.execute()
             self.history.append(command)
+        self.commit(batch)
 
         print('File created.\n')
 
@@ -69,21 +100,293 @@ class Invoker:
 
         print('Deleting file...')
 
+        batch = self.begin(self.delete_file_commands)
         for command in self.delete_file_commands:
             command.execute()
             self.history.append(command)
+        self.commit(batch)
 
         print('File deleted.\n')
 
     def undo_all(self):
         print('Undo all...')
+        batch = self.begin(self.history, undo=True)
         for command in self.history:
             command.undo()
+        self.commit(batch)
+
+        print('Undo all finished...')
+
+
+class BatchInvoker(Invoker):
+    """
+    Invoker that runs each group of commands on a pool of worker threads
+    and touches every file name only once per group.
+    """
+
+    def __init__(self, create_file_commands=None, delete_file_commands=None,
+                 workers=32, journal=None):
+        super().__init__(create_file_commands, delete_file_commands, journal)
+        self.workers = workers
+
+    def run_batch(self, commands, action, done=None):
+        """
+        Call action(command) in parallel, one command per file name. Each
+        command is appended to done as soon as its action returns, so done
+        holds the commands that succeeded even when an error is raised.
+        """
+        unique = list({command.receiver.file_name: command
+                       for command in commands}.values())
+        if done is None:
+            done = []
+
+        def run(chunk):
+            for command in chunk:
+                action(command)
+                done.append(command)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            chunks = [unique[i::self.workers] for i in range(self.workers)]
+            for _ in pool.map(run, chunks):  # Re-raises the first error
+                pass
 
+    def create_file(self):
+        print('Creating files...')
+        batch = self.begin(self.create_file_commands)
+        done = []
+        try:
+            self.run_batch(self.create_file_commands,
+                           operator.methodcaller('execute'), done)
+        finally:
+            self.history.extend(done)  # Even on error, for undo_all()
+        self.commit(batch)
+        print('Files created.\n')
+
+    def delete_file(self):
+        print('Deleting files...')
+        batch = self.begin(self.delete_file_commands)
+        done = []
+        try:
+            self.run_batch(self.delete_file_commands,
+                           operator.methodcaller('execute'), done)
+        finally:
+            self.history.extend(done)  # Even on error, for undo_all()
+        self.commit(batch)
+        print('Files deleted.\n')
+
+    def undo_all(self):
+        print('Undo all...')
+        batch = self.begin(self.history, undo=True)
+        self.run_batch(self.history, operator.methodcaller('undo'))
+        self.commit(batch)
         print('Undo all finished...')
 
 
+COMMANDS = {'TouchCommand': TouchCommand}
+
+
+class Journal:
+    """
+    Append-only log of the commands an Invoker runs, one JSON record per
+    line. A background thread writes all the records appended while the
+    previous fsync was running (up to `max_batch`, optionally waiting
+    `max_delay` seconds for more) with one write and one fsync, so
+    concurrent invokers share the cost of each fsync.
+
+    A batch of commands is logged and made durable before it runs (or is
+    undone, which its begin record notes) and is marked committed after.
+    recover() rolls back the batches a crash left without a commit: it
+    undoes the commands of a batch that ran them, and runs again those
+    of a batch that undid them.
+
+    If writing the log fails, the error is raised by the waiting and by
+    every later append(), sync() and close(): the records after it may
+    be lost, so nothing can be made durable any more.
+    """
+
+    def __init__(self, path, max_delay=0.0, max_batch=1024):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.incomplete, self._batches = self._scan(path)
+        self._file = open(path, 'ab')
+        self._pending = []
+        self._appended = 0
+        self._written = 0
+        self._closed = False
+        self._error = None
+        self._changed = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _scan(path):
+        open_batches = {}
+        batches = 0
+        try:
+            with open(path, 'r+b') as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        record = json.loads(line)
+                    except ValueError:  # Torn last write: cut it off
+                        file.seek(-len(line), os.SEEK_CUR)
+                        file.truncate()
+                        break
+                    batch = record['batch']
+                    batches = max(batches, batch + 1)
+                    if record['op'] == 'begin':
+                        open_batches[batch] = (record.get('undo', False), [])
+                    elif record['op'] == 'command':
+                        open_batches[batch][1].append(record)
+                    else:  # 'commit' or 'abort'
+                        open_batches.pop(batch, None)
+        except FileNotFoundError:
+            pass
+        return sorted((batch, undo, records) for batch, (undo, records)
+                      in open_batches.items()), batches
+
+    def recover(self):
+        """Roll back every batch interrupted by a crash."""
+        for batch, undo, records in self.incomplete:
+            for record in reversed(records):
+                command = COMMANDS[record['command']].from_record(record)
+                try:
+                    command.execute() if undo else command.undo()
+                except FileNotFoundError:
+                    pass
+            self.append({'op': 'abort', 'batch': batch})
+        self.incomplete = []
+        self.sync()
+
+    def begin(self, commands, undo=False):
+        with self._changed:
+            batch = self._batches
+            self._batches += 1
+        self.append({'op': 'begin', 'batch': batch, 'undo': undo}, wait=False)
+        for command in commands:
+            self.append(dict(command.to_record(), op='command', batch=batch),
+                        wait=False)
+        self.sync()
+        return batch
+
+    def commit(self, batch):
+        self.append({'op': 'commit', 'batch': batch})
+
+    def append(self, record, wait=True):
+        line = json.dumps(record).encode() + b'\n'
+        with self._changed:
+            self._raise_error()
+            self._pending.append(line)
+            self._appended += 1
+            ticket = self._appended
+            self._changed.notify_all()
+            while wait and self._written < ticket:
+                self._changed.wait()
+            if wait:
+                self._raise_error()
+
+    def sync(self):
+        """Wait until every appended record is on disk."""
+        with self._changed:
+            while self._written < self._appended:
+                self._changed.wait()
+            self._raise_error()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._writer.join()
+        self._file.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write_loop(self):
+        while True:
+            with self._changed:
+                while not self._pending and not self._closed:
+                    self._changed.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.max_delay
+                while len(self._pending) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or self._closed:
+                        break
+                    self._changed.wait(timeout)
+                lines = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                written = self._written + len(lines)
+
+            try:
+                self._file.write(b''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as error:
+                with self._changed:
+                    self._error = self._error or error
+
+            with self._changed:
+                self._written = written
+                self._changed.notify_all()
+
+
+def benchmark_touch(count=20000):
+    print(f'Touching and removing {count} marker files')
+    for Class in (Invoker, BatchInvoker):
+        with tempfile.TemporaryDirectory() as directory:
+            commands = [
+                TouchCommand(TouchReceiver(os.path.join(directory, str(i))))
+                for i in range(count)]
+            invoker = Class(commands)
+            start = time.perf_counter()
+            invoker.create_file()
+            invoker.undo_all()
+            elapsed = time.perf_counter() - start
+            assert not os.listdir(directory)
+        print(f'{Class.__name__}: {elapsed:.3f}s\n')
+
+
+def benchmark_journal(threads=8, count=200):
+    print(f'{threads} threads journaling {count} single-file batches each')
+    for max_batch in (1, 1024):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(os.path.join(directory, 'journal'),
+                              max_batch=max_batch)
+
+            def work(n):
+                for i in range(count):
+                    file_name = os.path.join(directory, f'{n}-{i}')
+                    invoker = Invoker([TouchCommand(TouchReceiver(file_name))],
+                                      journal=journal)
+                    invoker.create_file()
+
+            workers = [threading.Thread(target=work, args=(n,))
+                       for n in range(threads)]
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            sys.stdout.close()
+            sys.stdout = stdout
+            journal.close()
+        mode = 'fsync per record' if max_batch == 1 else 'group commit'
+        print(f'{mode}: {threads * count / elapsed:.0f} commands/s')
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-B":  # Benchmarks
+        benchmark_touch()
+        benchmark_journal()
+        return
+
     # Client
     touch_receiver = TouchReceiver('file_name')
     touch_command = TouchCommand(touch_receiver)
@@ -9,17 +9,22 @@ EXAMPLE - https://github.com/pkolt/design_patterns/blob/master/behavior/chain_of
 и передает запрос вдоль этой цепочки, пока его не обработают.
 """
 import abc
+import time
 
 
 class HttpHandler(metaclass=abc.ABCMeta):
     """Абстрактный класс обработчика"""
 
+    codes = ()  # Коды, которые может обработать обработчик; пусто - любые
+    pinned = False  # Не переставлять обработчик в адаптивном режиме
+
     @abc.abstractmethod
     def handle(self, code):
         pass
 
 
 class Http404Handler(HttpHandler):
+    codes = (404,)
 
     def handle(self, code):
         """Обработчик для кода 404"""
@@ -28,6 +33,7 @@ class Http404Handler(HttpHandler):
 
 
 class Http500Handler(HttpHandler):
+    codes = (500,)
 
     def handle(self, code):
         """Обработчик для кода 500"""
@@ -35,26 +41,109 @@ class Http500Handler(HttpHandler):
             return 'Ошибка сервера'
 
 
+class Http5xxHandler(HttpHandler):
+
+    def handle(self, code):
+        """Обработчик для любых ошибок сервера"""
+        if 500 <= code < 600:
+            return 'Сервис недоступен'
+
+
+def hot_first(handlers, hits):
+    """
+    Отсортировать обработчики по убыванию числа срабатываний. Переставляются
+    только соседние обработчики одного вида: объявившие коды не меняются
+    местами с обработчиками без кодов, поэтому ответы не меняются.
+    Закреплённые (pinned) обработчики остаются на месте.
+    """
+    ordered, group = [], []
+    for h in handlers + [None]:
+        if group and (h is None or h.pinned
+                      or bool(h.codes) != bool(group[0].codes)):
+            ordered += sorted(group, key=lambda h: -hits.get(h, 0))
+            group = []
+        if h is not None and h.pinned:
+            ordered.append(h)
+        elif h is not None:
+            group.append(h)
+    return ordered
+
+
 class Client(object):
-    def __init__(self):
+    def __init__(self, adaptive=False, reorder_every=1000, instruments=None):
         self._handlers = []
+        self._any_code = []  # Обработчики без объявленных кодов
+        # Код -> обработчики, которые могут его обработать, в порядке
+        # добавления: объявившие этот код и не объявившие никаких кодов
+        self._by_code = {}
+        # Адаптивный режим: каждые reorder_every ответов самые часто
+        # срабатывающие обработчики переносятся в начало цепочки
+        self._adaptive = adaptive
+        self._reorder_every = reorder_every
+        self._responses = 0
+        # Срабатывания считаются отдельно для каждого списка: код (None для
+        # _any_code) -> обработчик -> число срабатываний
+        self._hits = {}
+        # Если задан экземпляр chain_tools.Instruments, в нём учитываются вызовы
+        # обработчиков; без него response() не делает лишней работы
+        self._instruments = instruments
+
+    def stats(self):
+        """Число срабатываний каждого обработчика по всем кодам."""
+        return [(h, sum(hits.get(h, 0) for hits in self._hits.values()))
+                for h in self._handlers]
+
+    def reorder(self):
+        self._any_code = hot_first(self._any_code, self._hits.get(None, {}))
+        for code, handlers in self._by_code.items():
+            self._by_code[code] = hot_first(handlers,
+                                            self._hits.get(code, {}))
 
     def add_handler(self, h):
         self._handlers.append(h)
+        if h.codes:
+            for code in dict.fromkeys(h.codes):
+                self._by_code.setdefault(code, list(self._any_code)).append(h)
+        else:
+            self._any_code.append(h)
+            for handlers in self._by_code.values():
+                handlers.append(h)
+
+    def _handle(self, h, code):
+        start = time.perf_counter_ns()
+        msg = h.handle(code)
+        self._instruments.record(type(h).__name__, bool(msg),
+                                 time.perf_counter_ns() - start)
+        return msg
 
     def response(self, code):
-        for h in self._handlers:
-            msg = h.handle(code)
+        key = code if code in self._by_code else None
+        for h in self._by_code.get(key, self._any_code):
+            if self._instruments is None:
+                msg = h.handle(code)
+            else:
+                msg = self._handle(h, code)
             if msg:
                 print(f'Ответ: {msg}')
                 break
         else:
+            h = None
             print('Код не обработан')
 
+        if self._adaptive:
+            if h is not None:
+                hits = self._hits.setdefault(key, {})
+                hits[h] = hits.get(h, 0) + 1
+            self._responses += 1
+            if self._responses % self._reorder_every == 0:
+                self.reorder()
+
 
 client = Client()
 client.add_handler(Http404Handler())
 client.add_handler(Http500Handler())
+client.add_handler(Http5xxHandler())
 client.response(400)  # Код не обработан
 client.response(404)  # Ответ: Страница не найдена
 client.response(500)  # Ответ: Ошибка сервера
+client.response(503)  # Ответ: Сервис недоступен
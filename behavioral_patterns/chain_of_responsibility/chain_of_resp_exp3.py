@@ -3,44 +3,77 @@
 EXAMPLE - https://github.com/azmikamis/pipbook/blob/master/any/eventhandler1.py
 """
 
+import io
+import abc
+import os
 import sys
+import time
 import random
 import string
+import hashlib
+import statistics
+import threading
+import traceback
+import contextlib
+import multiprocessing
+
+from array import array
+from itertools import compress
+
+try:
+    from .chain_tools import DebugWriter
+except ImportError:  # Run as a script
+    from chain_tools import DebugWriter
 
 random.seed(917)  # Don't want random for regression tests
 
-MOUSE, KEYPRESS, TIMER, TERMINATE = ("MOUSE", "KEYPRESS", "TIMER", "TERMINATE")
+MOUSE, KEYPRESS, TIMER, TERMINATE = range(4)
+
+
+def describe(kind, button=1, x=-1, y=-1, ctrl=False, shift=False, key="",
+             id=-1):
+    if kind == MOUSE:
+        return "Button {} ({}, {})".format(button, x, y)
+    elif kind == KEYPRESS:
+        return "Key {}{}{}".format(
+            "Ctrl+" if ctrl else "",
+            "Shift+" if shift else "",
+            key
+        )
+    elif kind == TIMER:
+        return "Timer {}".format(id)
+    elif kind == TERMINATE:
+        return "Terminate"
 
 
 class Event:
 
     TimerId = 0
 
-    def __init__(self, kind, **kwargs):
+    __slots__ = ("kind", "button", "x", "y", "ctrl", "shift", "key", "id",
+                 "_text")
+
+    def __init__(self, kind, button=1, x=-1, y=-1, ctrl=False, shift=False,
+                 key="", id=-1):
         assert kind in {MOUSE, KEYPRESS, TIMER, TERMINATE}
         self.kind = kind
-        self.kwargs = kwargs
+        self.button = button
+        self.x = x
+        self.y = y
+        self.ctrl = ctrl
+        self.shift = shift
+        self.key = key
+        self.id = id
         if self.kind == TIMER:
-            self.kwargs["id"] = Event.TimerId
+            self.id = Event.TimerId
             Event.TimerId += 1
+        self._text = None
 
     def __str__(self):
-        if self.kind == MOUSE:
-            return "Button {} ({}, {})".format(
-                self.kwargs.get("button", 1),
-                self.kwargs.get("x", -1),
-                self.kwargs.get("y", -1)
-            )
-        elif self.kind == KEYPRESS:
-            return "Key {}{}{}".format(
-                "Ctrl+" if self.kwargs.get("ctrl", False) else "",
-                "Shift+" if self.kwargs.get("shift", False) else "",
-                self.kwargs.get("key", "")
-            )
-        elif self.kind == TIMER:
-            return "Timer {}".format(self.kwargs.get("id", -1))
-        elif self.kind == TERMINATE:
-            return "Terminate"
+        if self._text is None:  # Events don't change: format only once
+            self._text = describe(self.kind, self.button, self.x, self.y,
+                                  self.ctrl, self.shift, self.key, self.id)
+        return self._text
 
     @staticmethod
     def next():
@@ -61,15 +94,142 @@ class Event:
         return Event(kind)  # TIMER or TERMINATE
 
 
+class EventBatch:
+    """
+    A run of events kept column-wise in typed arrays, one entry per event,
+    rather than as one object each. Handlers take the batch together with
+    a mask of the rows still to be handled (a byte per row, 1 to handle),
+    so a chain walks the batch once per handler instead of once per event.
+    """
+
+    CTRL, SHIFT = 1, 2  # Bits of flags
+
+    def __init__(self, events=()):
+        self.kinds = array("b")
+        self.buttons = array("b")
+        self.xs = array("i")
+        self.ys = array("i")
+        self.flags = array("B")
+        self.keys = bytearray()  # ord() of the key, 0 for none
+        self.ids = array("l")
+        for event in events:
+            self.append(event)
+
+    def append(self, event):
+        self.kinds.append(event.kind)
+        self.buttons.append(event.button)
+        self.xs.append(event.x)
+        self.ys.append(event.y)
+        self.flags.append((self.CTRL if event.ctrl else 0) |
+                          (self.SHIFT if event.shift else 0))
+        self.keys.append(ord(event.key) if event.key else 0)
+        self.ids.append(event.id)
+
+    @classmethod
+    def generate(cls, count, seed=None, first_id=0):
+        """
+        `count` events drawn like Event.next() draws them, a column at a
+        time, from a random.Random(seed) of their own, so the same seed
+        gives the same batch. Timers are numbered from first_id.
+        """
+        rng = random.Random(seed)
+        batch = cls()
+        kinds = rng.choices((MOUSE, KEYPRESS, TIMER, TERMINATE),
+                            (7, 11, 5, 1), k=count)
+        batch.kinds = array("b", kinds)
+        batch.buttons = array("b", [1]) * count
+        batch.xs = array("i", [-1]) * count
+        batch.ys = array("i", [-1]) * count
+        batch.flags = array("B", bytes(count))
+        batch.keys = bytearray(count)
+        batch.ids = array("l", [-1]) * count
+
+        rows = list(batch.rows(batch.mask(MOUSE)))
+        for row, button, x, y in zip(
+                rows, rng.choices((1, 2, 3), k=len(rows)),
+                rng.choices(range(641), k=len(rows)),
+                rng.choices(range(481), k=len(rows))):
+            batch.buttons[row], batch.xs[row], batch.ys[row] = button, x, y
+        rows = list(batch.rows(batch.mask(KEYPRESS)))
+        for row, ctrl, shift, key in zip(
+                rows, rng.choices((0, cls.CTRL), (6, 1), k=len(rows)),
+                rng.choices((0, cls.SHIFT), (4, 1), k=len(rows)),
+                rng.choices(string.ascii_lowercase.encode(), k=len(rows))):
+            batch.flags[row], batch.keys[row] = ctrl | shift, key
+        for id, row in enumerate(batch.rows(batch.mask(TIMER)), first_id):
+            batch.ids[row] = id
+        return batch
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __fields(self, row):
+        flags, key = self.flags[row], self.keys[row]
+        return (self.kinds[row], self.buttons[row], self.xs[row],
+                self.ys[row], bool(flags & self.CTRL),
+                bool(flags & self.SHIFT), chr(key) if key else "",
+                self.ids[row])
+
+    def __getitem__(self, row):
+        event = Event.__new__(Event)  # Not __init__: keep the timer id
+        (event.kind, event.button, event.x, event.y, event.ctrl,
+         event.shift, event.key, event.id) = self.__fields(row)
+        event._text = None
+        return event
+
+    def text(self, row):
+        return describe(*self.__fields(row))
+
+    def mask(self, kind):
+        """A byte per row: 1 for the rows of the given kind, 0 for others."""
+        table = bytearray(256)
+        table[kind] = 1
+        return self.kinds.tobytes().translate(table)
+
+    def split(self, kind, mask=None):
+        """
+        Masks of the rows selected by mask (all if None) of the given kind,
+        and of the other ones. The masks are combined as integers, so no
+        Python code runs per row.
+        """
+        count = len(self)
+        kinds = int.from_bytes(self.mask(kind), "little")
+        rows = int.from_bytes(mask or b"\x01" * count, "little")
+        matched = rows & kinds
+        return (matched.to_bytes(count, "little"),
+                (rows ^ matched).to_bytes(count, "little"))
+
+    def rows(self, mask=None):
+        """The numbers of the rows selected by mask (all if None)."""
+        if mask is None:
+            return range(len(self))
+        return compress(range(len(self)), mask)
+
+
 class NullHandler:
 
+    kind = None  # Kind of the events the handler consumes, None: it passes all
+    pinned = False  # Keep the handler in place when the chain is reordered
+
     def __init__(self, successor=None):
         self.__successor = successor
 
+    @property
+    def successor(self):
+        return self.__successor
+
+    @successor.setter
+    def successor(self, successor):
+        self.__successor = successor
+
     def handle(self, event):
         if self.__successor is not None:
             self.__successor.handle(event)
 
+    def handle_batch(self, batch, mask=None):
+        if self.__successor is not None and (mask is None or 1 in mask):
+            self.__successor.handle_batch(batch, mask)
+
 
 class DebugHandler(NullHandler):
 
@@ -77,39 +237,534 @@ class DebugHandler(NullHandler):
         super().__init__(successor)
         self.__file = file
 
-    def handle(self, event):
+    def action(self, event):
         self.__file.write(f'*DEBUG*: {event}\n')
+
+    def handle(self, event):
+        self.action(event)
         super().handle(event)
 
+    def handle_batch(self, batch, mask=None):
+        self.__file.writelines(f'*DEBUG*: {batch.text(row)}\n'
+                               for row in batch.rows(mask))
+        super().handle_batch(batch, mask)
+
+
+class BufferedDebugHandler(DebugHandler):
+    """
+    A DebugHandler leaving the formatting and writing to a DebugWriter;
+    a TERMINATE event waits for the lines before it to be written, and
+    close() must be called once the chain is done with.
+    """
+
+    def __init__(self, successor=None, file=sys.stdout, maxsize=65536,
+                 block=True):
+        super().__init__(successor, file)
+        self.writer = DebugWriter(file, maxsize, block)
+
+    def action(self, event):
+        self.writer.put(event)
+        if event.kind == TERMINATE:
+            self.writer.flush()
+
+    def handle_batch(self, batch, mask=None):
+        self.writer.put_rows(batch, mask)
+        if 1 in batch.split(TERMINATE, mask)[0]:
+            self.writer.flush()
+        NullHandler.handle_batch(self, batch, mask)
 
-class MouseHandler(NullHandler):
+    def close(self):
+        self.writer.close()
+
+
+class KindHandler(NullHandler, metaclass=abc.ABCMeta):
+    """Consumes the events of its kind with action(), passes the others."""
+
+    @abc.abstractmethod
+    def action(self, event):
+        pass
+
+    def batch_action(self, batch, mask):
+        """action() on the rows of mask; override to skip building events."""
+        for row in batch.rows(mask):
+            self.action(batch[row])
 
     def handle(self, event):
-        if event.kind == MOUSE:
-            print(f'Click:   {event}')
+        if event.kind == self.kind:
+            self.action(event)
         else:
             super().handle(event)
 
+    def handle_batch(self, batch, mask=None):
+        matched, rest = batch.split(self.kind, mask)
+        self.batch_action(batch, matched)
+        super().handle_batch(batch, rest)
 
-class KeyHandler(NullHandler):
 
-    def handle(self, event):
-        if event.kind == KEYPRESS:
-            print(f'Press:   {event}')
+class PrintHandler(KindHandler):
+    """Prints the events of its kind after its label."""
+
+    label = ""
+
+    def action(self, event):
+        print(f'{self.label}{event}')
+
+    def batch_action(self, batch, mask):
+        sys.stdout.writelines(f'{self.label}{batch.text(row)}\n'
+                              for row in batch.rows(mask))
+
+
+class MouseHandler(PrintHandler):
+
+    kind = MOUSE
+    label = 'Click:   '
+
+
+class KeyHandler(PrintHandler):
+
+    kind = KEYPRESS
+    label = 'Press:   '
+
+
+class TimerHandler(PrintHandler):
+
+    kind = TIMER
+    label = 'Timeout: '
+
+
+def iter_chain(handler):
+    """The handlers of the chain starting at handler, in order."""
+    while handler is not None:
+        yield handler
+        handler = handler.successor
+
+
+def chain_steps(handler):
+    """
+    The chain starting at handler as a list of (handler, kind, action,
+    consumes) steps: action(event) is called for the events of kind (all
+    if None), and if consumes the event goes no further. A handler
+    overriding handle() is a step of its own handle(), taking every event
+    that reaches it, and ends the list: it decides itself what it passes on.
+    """
+    steps = []
+    for step in iter_chain(handler):
+        handle = type(step).handle
+        if handle is NullHandler.handle:
+            continue
+        elif handle is KindHandler.handle:
+            steps.append((step, step.kind, step.action, True))
+        elif handle is DebugHandler.handle:
+            steps.append((step, None, step.action, False))
         else:
-            super().handle(event)
+            steps.append((step, None, step.handle, True))
+            break
+    return steps
+
+
+class IterativeChain:
+    """
+    Run the chain starting at head as a loop over its steps (see
+    chain_steps()) rather than by each handler calling its successor, so
+    the stack stays flat however long the chain is. The steps are taken
+    once: relink the chain and it needs a new IterativeChain.
+    """
+
+    def __init__(self, head):
+        self.__steps = [step[1:] for step in chain_steps(head)]
+
+    def handle(self, event):
+        kind = event.kind
+        for accepts, action, consumes in self.__steps:
+            if accepts is None or accepts == kind:
+                action(event)
+                if consumes:
+                    return
+
+
+class AdaptiveChain:
+    """
+    Keep a handler chain ordered hottest first. Each event is counted as a
+    hit of the first handler declaring its kind, and every `reorder_every`
+    events the chain is relinked so that the handlers hit most often come
+    first. Handlers without a kind see every event that reaches them (like
+    DebugHandler), so they stay in place, as do pinned handlers; the
+    others never move across them.
+    """
+
+    def __init__(self, head, reorder_every=1000):
+        self.__reorder_every = reorder_every
+        self.__events = 0
+        self.__hits = {}
+        self.__relink(list(iter_chain(head)))
+
+    def __relink(self, handlers):
+        for handler, successor in zip(handlers, handlers[1:] + [None]):
+            handler.successor = successor
+        self.head = handlers[0]
+        self.__consumers = {}
+        for handler in handlers:
+            if handler.kind is not None:
+                self.__consumers.setdefault(handler.kind, handler)
+
+    def handle(self, event):
+        consumer = self.__consumers.get(event.kind)
+        if consumer is not None:
+            self.__hits[consumer] = self.__hits.get(consumer, 0) + 1
+        self.head.handle(event)
+        self.__events += 1
+        if self.__events % self.__reorder_every == 0:
+            self.reorder()
+
+    def reorder(self):
+        ordered, movable = [], []
+        for handler in [*iter_chain(self.head), None]:
+            if handler is None or handler.kind is None or handler.pinned:
+                ordered += sorted(movable,
+                                  key=lambda h: -self.__hits.get(h, 0))
+                ordered.append(handler)
+                movable = []
+            else:
+                movable.append(handler)
+        self.__relink(ordered[:-1])
 
+    def stats(self):
+        """(handler, hits) pairs in the current order of the chain."""
+        return [(handler, self.__hits.get(handler, 0))
+                for handler in iter_chain(self.head)]
 
-class TimerHandler(NullHandler):
+
+class InstrumentedChain:
+    """
+    Run the chain starting at head step by step (see chain_steps()),
+    timing each handler on its own and recording it in instruments under
+    "<position> <class name>": a hit when the handler consumes the event,
+    a pass otherwise. The handlers themselves are left as they are, so
+    the chain costs nothing extra when run without it.
+    """
+
+    def __init__(self, head, instruments):
+        self.__instruments = instruments
+        self.__steps = [(f'{position} {type(step).__name__}', kind, action,
+                         consumes)
+                        for position, (step, kind, action, consumes)
+                        in enumerate(chain_steps(head))]
 
     def handle(self, event):
-        if event.kind == TIMER:
-            print(f'Timeout: {event}')
+        kind, clock, record = (event.kind, time.perf_counter_ns,
+                               self.__instruments.record)
+        for name, accepts, action, consumes in self.__steps:
+            start = clock()
+            if accepts is None or accepts == kind:
+                action(event)
+                if consumes:
+                    record(name, True, clock() - start)
+                    return
+            record(name, False, clock() - start)
+
+
+def compile_chain(handler):
+    """
+    Generate one function doing what the chain starting at handler does,
+    with the kind tests inlined and the actions bound as globals, so no
+    hop costs a method lookup or a super() call. The chain is read once
+    (see chain_steps()): relink it and it must be compiled again.
+    """
+    lines = ["def chain(event):", "    kind = event.kind"]
+    namespace = {}
+    for i, (_, kind, action, consumes) in enumerate(chain_steps(handler)):
+        name = f"step{i}"
+        namespace[name] = action
+        if kind is not None:
+            lines += [f"    if kind == {kind!r}:",
+                      f"        return {name}(event)"]
+        elif consumes:
+            lines.append(f"    return {name}(event)")
         else:
+            lines.append(f"    {name}(event)")
+    exec("\n".join(lines), namespace)
+    return namespace["chain"]
+
+
+def debug_chain():
+    return DebugHandler(TimerHandler(KeyHandler(MouseHandler())),
+                        file=sys.stdout)  # The stdout of the caller's time
+
+
+def _shard(conn, chain_factory):
+    """
+    Run a copy of the chain on the batches coming through conn, sending
+    back the output of each event, or (None, traceback) if it fails.
+    """
+    try:
+        sys.stdout = output = io.StringIO()
+        handler = chain_factory()
+        while (message := conn.recv()) is not None:
+            sequence, batch = message
+            texts = []
+            for row in range(len(batch)):
+                handler.handle(batch[row])
+                texts.append(output.getvalue())
+                output.seek(0)
+                output.truncate()
+            conn.send((sequence, texts))
+        conn.send(None)
+    except Exception:
+        conn.send((None, traceback.format_exc()))
+
+
+class ShardError(Exception):
+    """A process of a ShardedRunner failed."""
+
+
+class ShardedRunner:
+    """
+    Run a handler chain on several processes. Events are routed by
+    key(event), their kind by default, so the events of a key always meet
+    the same copy of the chain in their order; they travel as pickled
+    EventBatches over pipes. Each process builds its chain with
+    chain_factory() and its output is captured per event, then written
+    in the order of the events as soon as all the events before have
+    been. chain_factory() should be a module level function (the
+    processes may have to unpickle it) that writes to sys.stdout as it is
+    when called. If a process fails, run() raises ShardError.
+    """
+
+    def __init__(self, chain_factory, processes=None, key=None,
+                 batch_size=1024):
+        self.__chain_factory = chain_factory
+        self.__processes = processes or os.cpu_count()
+        self.__key = key or (lambda event: event.kind)
+        self.__batch_size = batch_size
+
+    def run(self, events, file=None):
+        """Handle events up to a TERMINATE, returns how many there were."""
+        file = file or sys.stdout
+        lock = threading.Lock()
+        done, errors = {}, []  # Output of the events not yet written
+        written = 0
+
+        def receive(conn):
+            nonlocal written
+            try:
+                while (message := conn.recv()) is not None:
+                    sequence, texts = message
+                    if sequence is None:
+                        errors.append(texts)
+                        return
+                    with lock:
+                        done.update(zip(sequence, texts))
+                        while written in done:
+                            file.write(done.pop(written))
+                            written += 1
+            except (EOFError, OSError):  # Its exit code tells more
+                pass
+
+        shards = []
+        for _ in range(self.__processes):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_shard, args=(child, self.__chain_factory))
+            process.start()
+            child.close()  # Or the pipe stays open if the process dies
+            receiver = threading.Thread(  # Keeps the pipe from filling up
+                target=receive, args=(conn,))
+            receiver.start()
+            shards.append((conn, process, receiver,
+                           [array("l"), EventBatch()]))
+        count = 0
+        try:
+            for event in events:
+                if event.kind == TERMINATE or errors:
+                    break
+                conn, *_, pending = shards[
+                    hash(self.__key(event)) % len(shards)]
+                pending[0].append(count)
+                pending[1].append(event)
+                if len(pending[0]) == self.__batch_size:
+                    conn.send(pending)
+                    pending[:] = [array("l"), EventBatch()]
+                count += 1
+            for conn, _, _, pending in shards:
+                if pending[0]:
+                    conn.send(pending)
+        except OSError:  # A process is gone, its receiver tells why
+            pass
+        finally:
+            for conn, process, receiver, _ in shards:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+                receiver.join()
+                process.join()
+                conn.close()
+                if process.exitcode and not errors:
+                    errors.append(f"A shard process exited with code "
+                                  f"{process.exitcode}")
+        if errors:
+            raise ShardError("\n".join(errors))
+        return count
+
+
+def busy_chain(rounds=200):
+    """A debug_chain() hashing each event `rounds` times first."""
+    class DigestHandler(NullHandler):
+        def handle(self, event):
+            digest = str(event).encode()
+            for _ in range(rounds):
+                digest = hashlib.sha256(digest).digest()
             super().handle(event)
+    return DigestHandler(debug_chain())
+
+
+def load_test(handler, batch, file=sys.stdout):
+    """
+    Run the events of batch through the chain starting at handler twice:
+    once for its events/s, then through an InstrumentedChain timing each
+    handler on its own for its latency percentiles. Output of the handlers
+    goes to devnull.
+    """
+    class Latencies(dict):
+        def record(self, name, hit, ns):
+            self.setdefault(name, array("q")).append(ns)
+
+    latencies = Latencies()
+    instrumented = InstrumentedChain(handler, latencies)
+    events = [batch[row] for row in range(len(batch))]
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for event in events:
+            handler.handle(event)
+        elapsed = time.perf_counter() - start
+        for event in events:
+            instrumented.handle(event)
+    file.write(f'{len(events) / elapsed:.0f} events/s\n')
+    for name, latency in latencies.items():
+        if len(latency) > 1:
+            p50, p90, p99 = (statistics.quantiles(latency, n=100)[i]
+                             for i in (49, 89, 98))
+            file.write(f'  {name}: {len(latency)} events, p50 {p50:.0f}ns, '
+                       f'p90 {p90:.0f}ns, p99 {p99:.0f}ns\n')
+
+
+def benchmark_generate(events=1000000):
+    """Event.next() against EventBatch.generate(), then a load test."""
+    start = time.perf_counter()
+    for _ in range(events // 10):
+        Event.next()
+    elapsed = time.perf_counter() - start
+    print(f'Event.next():         {events // 10 / elapsed:9.0f} events/s')
+    start = time.perf_counter()
+    batch = EventBatch.generate(events, seed=917)
+    elapsed = time.perf_counter() - start
+    print(f'EventBatch.generate(): {events / elapsed:9.0f} events/s')
+    with open(os.devnull, "w") as devnull:
+        load_test(DebugHandler(TimerHandler(KeyHandler(MouseHandler())),
+                               file=devnull),
+                  EventBatch.generate(events // 10, seed=917))
+
+
+def benchmark_sharded(events=20000):
+    """A CPU bound chain on one process, and sharded on 1 to 4."""
+    sample = [event for event in (Event.next() for _ in range(events))
+              if event.kind != TERMINATE]
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            handler = busy_chain()
+            start = time.perf_counter()
+            for event in sample:
+                handler.handle(event)
+        elapsed = time.perf_counter() - start
+        print(f'in process:  {len(sample) / elapsed:8.0f} events/s')
+        for processes in (1, 2, 4):
+            runner = ShardedRunner(busy_chain, processes)
+            start = time.perf_counter()
+            runner.run(sample, file=devnull)
+            elapsed = time.perf_counter() - start
+            print(f'{processes} processes: {len(sample) / elapsed:8.0f} '
+                  f'events/s')
+
+
+def benchmark_debug(events=200000):
+    """The debugging chain with a DebugHandler and a BufferedDebugHandler."""
+    sample = [event for event in (Event.next() for _ in range(events))
+              if event.kind != TERMINATE]
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for debug in (DebugHandler, BufferedDebugHandler):
+            handler = debug(TimerHandler(KeyHandler(MouseHandler())),
+                            file=devnull)
+            start = time.perf_counter()
+            for event in sample:
+                handler.handle(event)
+            handler.handle(Event(TERMINATE))  # Wait for the writer
+            elapsed = time.perf_counter() - start
+            if debug is BufferedDebugHandler:
+                handler.close()
+            sys.__stdout__.write(f'{debug.__name__}: '
+                                 f'{len(sample) / elapsed:8.0f} events/s\n')
+
+
+def benchmark_chain(lengths=(10, 1000, 10000), events=10000):
+    """
+    Events that pass through the whole chain, per chain length, with the
+    handlers calling their successors and with an IterativeChain.
+    """
+    for length in lengths:
+        handler = MouseHandler()
+        for i in range(length - 1):
+            handler = (KeyHandler if i % 2 else TimerHandler)(handler)
+        event = Event(MOUSE)
+        count = max(events // length, 10)
+        for name, handle in (("recursive", handler.handle),
+                             ("iterative", IterativeChain(handler).handle)):
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                try:
+                    for _ in range(count):
+                        handle(event)
+                except RecursionError:
+                    elapsed = None
+                else:
+                    elapsed = time.perf_counter() - start
+            if elapsed is None:
+                print(f'{length:6} handlers, {name}: recursion limit')
+            else:
+                print(f'{length:6} handlers, {name}: '
+                      f'{elapsed / count * 1e6:10.1f}us/event, '
+                      f'{elapsed / count / length * 1e9:6.0f}ns/handler')
+
+
+def benchmark_compiled(events=200000):
+    """Per event cost of a chain and of its compiled function."""
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        handler = DebugHandler(TimerHandler(KeyHandler(MouseHandler(
+            NullHandler()))), file=devnull)
+        sample = [event for event in (Event.next() for _ in range(events))
+                  if event.kind != TERMINATE]
+        timings = []
+        for handle in (handler.handle, compile_chain(handler)):
+            start = time.perf_counter()
+            for event in sample:
+                handle(event)
+            timings.append((time.perf_counter() - start) / len(sample))
+    print(f'chain:    {timings[0] * 1e9:6.0f}ns/event')
+    print(f'compiled: {timings[1] * 1e9:6.0f}ns/event '
+          f'({timings[0] / timings[1]:.1f}x)')
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-B":  # Benchmarks
+        benchmark_chain()
+        benchmark_compiled()
+        benchmark_sharded()
+        benchmark_debug()
+        benchmark_generate()
+        return
     print("Handler Chain #1")
     handler1 = TimerHandler(KeyHandler(MouseHandler(NullHandler())))
     # Could pass None or nothing instead of the NullHandler
@@ -127,6 +782,30 @@ def main():
             break
         handler2.handle(event)
 
+    print("\nHandler Chain #3 (adaptive)")
+    handler3 = AdaptiveChain(
+        MouseHandler(TimerHandler(KeyHandler(NullHandler()))),
+        reorder_every=5)
+    while True:
+        event = Event.next()
+        if event.kind == TERMINATE:
+            break
+        handler3.handle(event)
+    for handler, hits in handler3.stats():
+        print(f'{type(handler).__name__}: {hits} hits')
+
+    print("\nHandler Chain #4 (batched)")
+    batch = EventBatch()
+    while True:
+        event = Event.next()
+        if event.kind == TERMINATE:
+            break
+        batch.append(event)
+    DebugHandler(handler1).handle_batch(batch)
+
+    print("\nHandler Chain #5 (sharded)")
+    ShardedRunner(debug_chain, processes=2).run(iter(Event.next, None))
+
 
 if __name__ == "__main__":
     main()
@@ -2,45 +2,70 @@
 """
 EXAMPLE - https://github.com/azmikamis/pipbook/blob/master/any/eventhandler2.py
 """
+import asyncio
 import functools
+import os
+import inspect
 import random
 import sys
 import string
+import threading
+import time
+
+try:
+    from .chain_tools import DebugWriter, Instruments
+except ImportError:  # Run as a script
+    from chain_tools import DebugWriter, Instruments
 
 random.seed(917)  # Don't want random for regression tests
 
-MOUSE, KEYPRESS, TIMER, TERMINATE = ("MOUSE", "KEYPRESS", "TIMER", "TERMINATE")
+MOUSE, KEYPRESS, TIMER, TERMINATE = range(4)
+
+
+def describe(kind, button=1, x=-1, y=-1, ctrl=False, shift=False, key="",
+             id=-1):
+    if kind == MOUSE:
+        return "Button {} ({}, {})".format(button, x, y)
+    elif kind == KEYPRESS:
+        return "Key {}{}{}".format(
+            "Ctrl+" if ctrl else "",
+            "Shift+" if shift else "",
+            key
+        )
+    elif kind == TIMER:
+        return "Timer {}".format(id)
+    elif kind == TERMINATE:
+        return "Terminate"
 
 
 class Event:
 
     TimerId = 0
 
-    def __init__(self, kind, **kwargs):
+    __slots__ = ("kind", "button", "x", "y", "ctrl", "shift", "key", "id",
+                 "_text")
+
+    def __init__(self, kind, button=1, x=-1, y=-1, ctrl=False, shift=False,
+                 key="", id=-1):
         assert kind in {MOUSE, KEYPRESS, TIMER, TERMINATE}
         self.kind = kind
-        self.kwargs = kwargs
+        self.button = button
+        self.x = x
+        self.y = y
+        self.ctrl = ctrl
+        self.shift = shift
+        self.key = key
+        self.id = id
         if self.kind == TIMER:
-            self.kwargs["id"] = Event.TimerId
+            self.id = Event.TimerId
             Event.TimerId += 1
+        self._text = None
 
     def __str__(self):
-        if self.kind == MOUSE:
-            return "Button {} ({}, {})".format(
-                self.kwargs.get("button", 1),
-                self.kwargs.get("x", -1),
-                self.kwargs.get("y", -1)
-            )
-        elif self.kind == KEYPRESS:
-            return "Key {}{}{}".format(
-                "Ctrl+" if self.kwargs.get("ctrl", False) else "",
-                "Shift+" if self.kwargs.get("shift", False) else "",
-                self.kwargs.get("key", "")
-            )
-        elif self.kind == TIMER:
-            return "Timer {}".format(self.kwargs.get("id", -1))
-        elif self.kind == TERMINATE:
-            return "Terminate"
+        if self._text is None:  # Events don't change: format only once
+            self._text = describe(self.kind, self.button, self.x, self.y,
+                                  self.ctrl, self.shift, self.key, self.id)
+        return self._text
 
     @staticmethod
     def next():
@@ -78,6 +103,17 @@ def debug_handler(successor, file=sys.stdout):
         successor.send(event)
 
 
+@coroutine
+def buffered_debug_handler(successor, writer):
+    """debug_handler() leaving the writing to a DebugWriter."""
+    while True:
+        event = (yield)
+        writer.put(event)
+        if event.kind == TERMINATE:
+            writer.flush()
+        successor.send(event)
+
+
 @coroutine
 def mouse_handler(successor=None):
     while True:
@@ -108,7 +144,310 @@ def timer_handler(successor=None):
             successor.send(event)
 
 
+# Batch stages: each send() carries a list of events, and a stage sends
+# the ones it doesn't handle on to its successor in one list.
+
+@coroutine
+def batch_debug_handler(successor, file=sys.stdout):
+    while True:
+        events = (yield)
+        file.write("".join(f'*DEBUG*: {event}\n' for event in events))
+        successor.send(events)
+
+
+@coroutine
+def batch_kind_handler(kind, label, successor=None):
+    while True:
+        events = (yield)
+        lines, rest = [], []
+        for event in events:
+            if event.kind == kind:
+                lines.append(f'{label}{event}\n')
+            else:
+                rest.append(event)
+        sys.stdout.write("".join(lines))
+        if rest and successor is not None:
+            successor.send(rest)
+
+
+@coroutine
+def collector(events):
+    while True:
+        events.append((yield))
+
+
+@coroutine
+def batch_adapter(stage_factory, successor=None):
+    """
+    Run a single event stage, made by stage_factory(its successor), in a
+    batch pipeline: it is sent the events one by one, and those it passes
+    on go to successor together.
+    """
+    passed = []
+    stage = stage_factory(collector(passed))
+    while True:
+        events = (yield)
+        for event in events:
+            stage.send(event)
+        if passed and successor is not None:
+            successor.send(passed[:])
+        passed.clear()
+
+
+class Probe:
+    """
+    Stands in for a coroutine stage, recording each send() to it in
+    instruments under name. The time spent in the probes the stage sends
+    on to is left out, and an event the stage doesn't send on to another
+    probe counts as a hit. Stages without a probe cost nothing extra.
+    """
+
+    # Per thread: time spent in the inner probes, whether one was sent to
+    __nested = threading.local()
+
+    def __init__(self, name, stage, instruments):
+        self.__name = name
+        self.__stage = stage
+        self.__instruments = instruments
+
+    def send(self, event):
+        nested = Probe.__nested
+        outer = getattr(nested, "ns", 0)
+        nested.ns, nested.sent = 0, False
+        start = time.perf_counter_ns()
+        self.__stage.send(event)
+        elapsed = time.perf_counter_ns() - start
+        self.__instruments.record(self.__name, not nested.sent,
+                                  elapsed - nested.ns)
+        nested.ns, nested.sent = outer + elapsed, True
+
+
+def debug_stage(file=sys.stdout):
+    def stage(event):
+        file.write(f'*DEBUG*: {event}\n')
+        return event
+    return stage
+
+
+def kind_stage(kind, label):
+    def stage(event):
+        if event.kind == kind:
+            print(f'{label}{event}')
+            return None
+        return event
+    return stage
+
+
+class Stage:
+    """
+    One step of an AsyncPipeline: `workers` tasks taking events from a
+    bounded queue, calling handler(event), which may return an awaitable
+    (a coroutine function, or an object with an async __call__), and
+    passing what it returns on (None when it consumed the event).
+    reset() readies it for another run, clearing its counters.
+    """
+
+    def __init__(self, handler, workers=1, name=None, maxsize=100,
+                 instruments=None):
+        self.handler = handler
+        self.workers = workers
+        self.name = name or getattr(handler, "__qualname__", repr(handler))
+        self.instruments = instruments  # Records each call if given
+        self.__maxsize = maxsize
+        self.reset()
+
+    def reset(self):
+        self.queue = asyncio.Queue(self.__maxsize)
+        self.processed = 0
+        self.passed = 0
+        self.busy = 0.0  # Seconds spent in the handler, over all workers
+        self.max_depth = 0
+        self.__running = self.workers  # Workers yet to see the TERMINATE
+
+    async def put(self, event):
+        await self.queue.put(event)  # Waits while the queue is full
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def work(self, successor):
+        while True:
+            event = await self.queue.get()
+            if event.kind == TERMINATE:
+                self.__running -= 1
+                if self.__running:  # Let the other workers see it too
+                    await self.queue.put(event)
+                elif successor is not None:
+                    await successor.put(event)
+                return
+            start = time.perf_counter_ns()
+            event = self.handler(event)
+            if inspect.isawaitable(event):  # Coroutine handler
+                event = await event
+            elapsed = time.perf_counter_ns() - start
+            self.busy += elapsed / 1e9
+            self.processed += 1
+            if self.instruments is not None:
+                self.instruments.record(self.name, event is None, elapsed)
+            if event is not None:
+                self.passed += 1
+                if successor is not None:
+                    await successor.put(event)
+
+
+class AsyncPipeline:
+    """
+    The handlers as asyncio tasks connected by bounded queues, so a slow
+    stage (say, one waiting on I/O) fills its queue and holds up the
+    producer rather than the other stages, and its workers overlap their
+    waits. With several workers a stage may reorder events.
+    """
+
+    def __init__(self, maxsize=100, instruments=None):
+        self.__maxsize = maxsize
+        self.__instruments = instruments
+        self.stages = []
+
+    def stage(self, handler, workers=1, name=None):
+        self.stages.append(Stage(handler, workers, name, self.__maxsize,
+                                 self.__instruments))
+        return self
+
+    async def run(self, events):
+        """
+        Feed events up to a TERMINATE (sent if they run out). If a handler
+        raises, the rest of the pipeline is cancelled and run() raises.
+        """
+        for stage in self.stages:
+            stage.reset()
+        successors = self.stages[1:] + [None]
+        tasks = [asyncio.create_task(stage.work(successor))
+                 for stage, successor in zip(self.stages, successors)
+                 for _ in range(stage.workers)]
+        tasks.append(asyncio.create_task(self.__feed(events)))
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        self.elapsed = time.perf_counter() - start
+        return self.metrics()
+
+    async def __feed(self, events):
+        for event in events:
+            if event.kind == TERMINATE:
+                break
+            await self.stages[0].put(event)
+        await self.stages[0].put(Event(TERMINATE))
+
+    def metrics(self):
+        return [dict(name=stage.name, workers=stage.workers,
+                     processed=stage.processed, passed=stage.passed,
+                     busy=stage.busy, max_depth=stage.max_depth,
+                     rate=stage.processed / self.elapsed)
+                for stage in self.stages]
+
+
+def benchmark_batches(events=200000, sizes=(1, 64, 4096)):
+    """
+    A key, mouse and timer pipeline per event and in batches. Both kinds
+    of stages record the events they handle the same way, appending them
+    to a list, so the numbers show the cost of the protocol rather than
+    of the output.
+    """
+    sample = [event for event in (Event.next() for _ in range(events))
+              if event.kind != TERMINATE]
+    handled = []
+
+    @coroutine
+    def event_stage(kind, successor=None):
+        while True:
+            event = (yield)
+            if event.kind == kind:
+                handled.append(event)
+            elif successor is not None:
+                successor.send(event)
+
+    @coroutine
+    def batch_stage(kind, successor=None):
+        while True:
+            events = (yield)
+            rest = []
+            for event in events:
+                if event.kind == kind:
+                    handled.append(event)
+                else:
+                    rest.append(event)
+            if rest and successor is not None:
+                successor.send(rest)
+
+    pipeline = event_stage(KEYPRESS, event_stage(MOUSE, event_stage(TIMER)))
+    start = time.perf_counter()
+    for event in sample:
+        pipeline.send(event)
+    rates = [("per event", len(sample) / (time.perf_counter() - start))]
+    for size in sizes:
+        pipeline = batch_stage(KEYPRESS, batch_stage(MOUSE,
+                                                     batch_stage(TIMER)))
+        start = time.perf_counter()
+        for i in range(0, len(sample), size):
+            pipeline.send(sample[i:i + size])
+        rates.append((f'batches of {size}',
+                      len(sample) / (time.perf_counter() - start)))
+    assert len(handled) == len(sample) * (len(sizes) + 1)
+    for name, rate in rates:
+        print(f'{name:>16}: {rate:9.0f} events/s')
+
+
+def benchmark_debug(events=200000):
+    """The debugging pipeline with debug_handler() and a DebugWriter."""
+    sample = [event for event in (Event.next() for _ in range(events))
+              if event.kind != TERMINATE]
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            writer = DebugWriter(devnull)
+            for name, debug in (
+                    ("debug_handler", functools.partial(
+                        debug_handler, file=devnull)),
+                    ("buffered_debug_handler", functools.partial(
+                        buffered_debug_handler, writer=writer))):
+                pipeline = debug(key_handler(mouse_handler(timer_handler())))
+                start = time.perf_counter()
+                for event in sample:
+                    pipeline.send(event)
+                pipeline.send(Event(TERMINATE))  # Wait for the writer
+                elapsed = time.perf_counter() - start
+                sys.__stdout__.write(f'{name}: {len(sample) / elapsed:8.0f} '
+                                     f'events/s\n')
+            writer.close()
+        finally:
+            sys.stdout = sys.__stdout__
+
+
+def benchmark_pipeline(events=2000, delay=0.001):
+    """A stage waiting `delay` per event, run by 1 to 64 workers."""
+    async def persist(event):
+        await asyncio.sleep(delay)
+        return event
+
+    sample = [Event(KEYPRESS, key="a")] * events
+    for workers in (1, 8, 64):
+        pipeline = (AsyncPipeline()
+                    .stage(persist, workers=workers)
+                    .stage(kind_stage(MOUSE, "Click:   ")))
+        persisted = asyncio.run(pipeline.run(sample))[0]
+        print(f'{workers:3} workers: {persisted["rate"]:8.0f} events/s, '
+              f'max queue depth {persisted["max_depth"]}')
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-B":  # Benchmarks
+        benchmark_pipeline()
+        benchmark_debug()
+        benchmark_batches()
+        return
     print("Handler Chain #1")
     pipeline = key_handler(mouse_handler(timer_handler()))
     while True:
@@ -125,7 +464,44 @@ def main():
             break
         pipeline.send(event)
 
+    print("\nHandler Chain #3 (asyncio)")
+    pipeline = (AsyncPipeline(maxsize=4)
+                .stage(debug_stage(), name="debug")
+                .stage(kind_stage(KEYPRESS, "Press:   "), name="key")
+                .stage(kind_stage(MOUSE, "Click:   "), name="mouse")
+                .stage(kind_stage(TIMER, "Timeout: "), name="timer"))
+    metrics = asyncio.run(pipeline.run(iter(Event.next, None)))
+    for stage in metrics:
+        print(f'{stage["name"]}: {stage["processed"]} processed, '
+              f'{stage["passed"]} passed on, '
+              f'max queue depth {stage["max_depth"]}')
+
+    print("\nHandler Chain #4 (batched)")
+    pipeline = batch_debug_handler(batch_adapter(
+        key_handler, batch_kind_handler(
+            MOUSE, "Click:   ", batch_kind_handler(TIMER, "Timeout: "))))
+    events = []
+    while True:
+        event = Event.next()
+        if event.kind == TERMINATE:
+            break
+        events.append(event)
+    pipeline.send(events)
+
+    print("\nHandler Chain #5 (probed)")
+    instruments = Instruments()
+    pipeline = Probe("key", key_handler(Probe("mouse", mouse_handler(
+        Probe("timer", timer_handler(), instruments)), instruments)),
+        instruments)
+    while True:
+        event = Event.next()
+        if event.kind == TERMINATE:
+            break
+        pipeline.send(event)
+    for name, counters in instruments.handlers.items():
+        print(f'{name}: {counters["calls"]} calls, {counters["hits"]} hits, '
+              f'{counters["passes"]} passes')
+
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,165 @@
+"""
+Helpers shared by the handler chain examples of this package.
+"""
+import json
+import queue
+import sys
+import threading
+
+
+class DebugWriter:
+    """
+    Writes the debug lines of the events put() to it from a background
+    thread: put() only collects events, handing them over `batch` at a
+    time or once they have waited `max_delay` seconds, and the thread
+    formats and writes each batch in one go. When `maxsize` events are
+    waiting, handing over a batch waits (block=True) or drops it, counting
+    its events in dropped. An error of the file is raised by the next
+    flush() or close().
+    """
+
+    def __init__(self, file=sys.stdout, maxsize=65536, block=True,
+                 batch=1024, max_delay=0.1):
+        self.__file = file
+        self.__queue = queue.Queue(max(maxsize // batch, 1))
+        self.__block = block
+        self.__batch = batch
+        self.__max_delay = max_delay
+        self.__pending = []
+        self.__lock = threading.Lock()  # Guards pending
+        self.__error = None
+        self.dropped = 0
+        self.__thread = threading.Thread(target=self.__write_loop,
+                                         daemon=True)
+        self.__thread.start()
+
+    def put(self, event):
+        with self.__lock:
+            self.__pending.append(event)
+            if len(self.__pending) >= self.__batch:
+                self.__hand_over()
+
+    def put_rows(self, batch, mask=None):
+        """
+        Put the rows of an EventBatch selected by mask (all if None); they
+        are formatted from the batch by the thread, without building events.
+        """
+        with self.__lock:
+            self.__pending.append((batch, mask))
+            self.__hand_over()
+
+    def __hand_over(self):  # With the lock held
+        events, self.__pending = self.__pending, []
+        if self.__block:
+            self.__queue.put(events)
+        else:
+            try:
+                self.__queue.put_nowait(events)
+            except queue.Full:
+                self.dropped += sum(
+                    sum(1 for _ in event[0].rows(event[1]))
+                    if isinstance(event, tuple) else 1 for event in events)
+
+    def flush(self):
+        """Wait until the events put so far are written (or dropped)."""
+        with self.__lock:
+            if self.__pending:
+                self.__hand_over()
+        self.__queue.join()
+        error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.__queue.put(None)
+            self.__thread.join()
+
+    def __write_loop(self):
+        while True:
+            try:
+                events = self.__queue.get(timeout=self.__max_delay)
+            except queue.Empty:
+                self.__hand_over_late()
+                continue
+            if events is None:
+                self.__queue.task_done()
+                return
+            try:
+                self.__file.write("".join(self.__lines(events)))
+                self.__file.flush()
+            except Exception as error:
+                self.__error = self.__error or error
+            finally:
+                self.__queue.task_done()
+
+    def __hand_over_late(self):
+        """Hand over the events that waited too long, unless put() is busy."""
+        if not self.__lock.acquire(blocking=False):
+            return
+        try:
+            if self.__pending:
+                self.__queue.put_nowait(self.__pending)
+                self.__pending = []
+        except queue.Full:  # Some batches wait already: try again later
+            pass
+        finally:
+            self.__lock.release()
+
+    @staticmethod
+    def __lines(events):
+        for event in events:
+            if isinstance(event, tuple):
+                batch, mask = event
+                for row in batch.rows(mask):
+                    yield f'*DEBUG*: {batch.text(row)}\n'
+            else:
+                yield f'*DEBUG*: {event}\n'
+
+
+class Instruments:
+    """
+    Counts of the calls, hits and passes of each handler, with a histogram
+    of their latency in power of two nanosecond buckets, reported as text
+    or JSON.
+    """
+
+    def __init__(self):
+        self.handlers = {}  # Handler name -> its counters
+
+    def record(self, name, hit, ns):
+        counters = self.handlers.get(name)
+        if counters is None:
+            counters = self.handlers[name] = dict(
+                calls=0, hits=0, passes=0, ns=0, histogram={})
+        counters["calls"] += 1
+        counters["hits" if hit else "passes"] += 1
+        counters["ns"] += ns
+        bucket = 1 << ns.bit_length()  # Upper bound of the bucket
+        histogram = counters["histogram"]
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def percentile(self, name, q):
+        """Upper bound of the bucket holding the q quantile of calls."""
+        counters = self.handlers[name]
+        seen = 0
+        for bucket in sorted(counters["histogram"]):
+            seen += counters["histogram"][bucket]
+            if seen >= q * counters["calls"]:
+                return bucket
+
+    def report(self):
+        lines = []
+        for name, counters in self.handlers.items():
+            lines.append(
+                f'{name}: {counters["calls"]} calls, '
+                f'{counters["hits"]} hits, {counters["passes"]} passes, '
+                f'mean {counters["ns"] / counters["calls"]:.0f}ns, '
+                f'p50 <{self.percentile(name, 0.5)}ns, '
+                f'p99 <{self.percentile(name, 0.99)}ns')
+        return "\n".join(lines)
+
+    def to_json(self):
+        return json.dumps(self.handlers)